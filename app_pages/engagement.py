@@ -1,5 +1,5 @@
 import streamlit as st
-import pandas as pd
+import functools
 
 from settings import initialize
 from users import (
@@ -13,6 +13,9 @@ from millify import prettify
 from metrics import (
     get_filtered_cohort,
     get_funnel_step_counts_for_app,
+    get_multi_app_cohort,
+    multi_app_totals,
+    multi_app_funnel_by_group,
 )
 from ui_components import (
     stats_by_country_map,
@@ -76,90 +79,13 @@ def build_metrics_for_single_app(app, daterange, language, countries_list):
     }
 
 
-def build_metrics_for_all_apps(daterange, language, countries_list):
+def build_cohort_for_all_apps(daterange, language, countries_list):
     """
-    All-app mode: behaves exactly like the Funnel page's ALL logic.
-    Sum LR/LA/RA/GC across all apps; GPP/GCA weighted by LR.
+    All-app mode: every app's filter evaluated once, shared by the tiles,
+    the map and the Top 10s.  Apps are kept as separate slices, not concatenated.
     """
     all_apps = [a for a in ui.get_apps() if a != "All"]
-
-    totals = {"LR": 0, "LA": 0, "RA": 0, "GC": 0}
-    weighted_gpp_sum = 0.0
-    weighted_gca_sum = 0.0
-    total_LR_for_weights = 0
-
-    for app_name in all_apps:
-        _, counts = get_funnel_step_counts_for_app(
-            app=[app_name],
-            daterange=daterange,
-            language=language,
-            countries_list=countries_list,
-            funnel_size="compact",
-        )
-
-        LR_i = counts.get("LR", 0)
-
-        for k in ("LR", "LA", "RA", "GC"):
-            totals[k] += counts.get(k, 0)
-
-        if LR_i > 0:
-            weighted_gpp_sum += counts.get("GPP", 0.0) * LR_i
-            weighted_gca_sum += counts.get("GCA", 0.0) * LR_i
-            total_LR_for_weights += LR_i
-
-    GPP = weighted_gpp_sum / total_LR_for_weights if total_LR_for_weights > 0 else 0.0
-    GCA = weighted_gca_sum / total_LR_for_weights if total_LR_for_weights > 0 else 0.0
-
-    return {
-        "LR": totals["LR"],
-        "LA": totals["LA"],
-        "RA": totals["RA"],
-        "GC": totals["GC"],
-        "GPP": GPP,
-        "GCA": GCA,
-    }
-
-
-def build_combined_cohorts_for_all_apps(daterange, language, countries_list):
-    """
-    Build combined user_cohort_df and LR_df across all apps so that
-    the map and Top 10s truly reflect ALL app usage.
-
-    Returns:
-        combined_df, combined_LR_df
-    """
-    all_apps = [a for a in ui.get_apps() if a != "All"]
-
-    user_rows = []
-    lr_rows = []
-
-    for app_name in all_apps:
-        this_app = [app_name]
-        user_df, user_df_LR = get_filtered_cohort(
-            app=this_app,
-            daterange=daterange,
-            language=language,
-            countries_list=countries_list,
-        )
-
-        if user_df is not None and not user_df.empty:
-            df_copy = user_df.copy()
-            df_copy["app"] = app_name
-            user_rows.append(df_copy)
-
-        if user_df_LR is not None and not user_df_LR.empty:
-            lr_copy = user_df_LR.copy()
-            lr_copy["app"] = app_name
-            lr_rows.append(lr_copy)
-
-    combined_df = (
-        pd.concat(user_rows, ignore_index=True) if user_rows else pd.DataFrame()
-    )
-    combined_LR_df = (
-        pd.concat(lr_rows, ignore_index=True) if lr_rows else None
-    )
-
-    return combined_df, combined_LR_df
+    return get_multi_app_cohort(all_apps, daterange, language, countries_list)
 
 
 # ==========================================================
@@ -176,11 +102,13 @@ if len(daterange) == 2 and len(countries_list) > 0:
     # 1) METRICS (match Funnel page)
     # ------------------------------------------------------
     if app[0] == "All":
-        stats = build_metrics_for_all_apps(
+        # Sum LR/LA/RA/GC across all apps; GPP/GCA weighted by LR
+        multi_app_cohort = build_cohort_for_all_apps(
             daterange=daterange,
             language=language,
             countries_list=countries_list,
         )
+        stats = multi_app_totals(multi_app_cohort)
     else:
         stats = build_metrics_for_single_app(
             app=app,
@@ -225,12 +153,11 @@ if len(daterange) == 2 and len(countries_list) > 0:
     # ------------------------------------------------------
     # 2) BUILD COHORT DATAFRAMES FOR MAP + TOP 10s
     # ------------------------------------------------------
+    funnel_by_group = None
     if app[0] == "All":
-        user_cohort_df, user_cohort_df_LR = build_combined_cohorts_for_all_apps(
-            daterange=daterange,
-            language=language,
-            countries_list=countries_list,
-        )
+        # Map and Top 10s read the per-group funnel of the same multi-app cohort
+        user_cohort_df, LR_df = None, None
+        funnel_by_group = functools.partial(multi_app_funnel_by_group, multi_app_cohort)
     else:
         user_cohort_df, user_cohort_df_LR = get_filtered_cohort(
             app=app,
@@ -239,14 +166,11 @@ if len(daterange) == 2 and len(countries_list) > 0:
             countries_list=countries_list,
         )
 
-    # For CR, LR data comes from separate DF
-    if app[0] == "CR":
-        LR_df = user_cohort_df_LR
-    elif app[0] == "All":
-        # In ALL mode, LR_df is the combined LR_df when it exists
-        LR_df = user_cohort_df_LR if user_cohort_df_LR is not None else user_cohort_df
-    else:
-        LR_df = user_cohort_df
+        # For CR, LR data comes from separate DF
+        if app[0] == "CR":
+            LR_df = user_cohort_df_LR
+        else:
+            LR_df = user_cohort_df
 
     # ------------------------------------------------------
     # 3) WORLD MAP
@@ -268,6 +192,7 @@ if len(daterange) == 2 and len(countries_list) > 0:
         option=map_option,
         min_funnel=True,
         sort_by="Total",
+        funnel_by_group=funnel_by_group,
     )
 
     # ------------------------------------------------------
@@ -304,6 +229,7 @@ if len(daterange) == 2 and len(countries_list) > 0:
         option=top_option,
         display_category=display_category,
         app=app,
+        funnel_by_group=funnel_by_group,
     )
 
     # ------------------------------------------------------
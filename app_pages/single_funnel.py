@@ -3,8 +3,9 @@ from rich import print as rprint
 from  ui_components import create_funnels_by_cohort,create_engagement_figure
 import ui_widgets as ui
 from millify import prettify
-from metrics import get_funnel_step_counts_for_app,get_filtered_cohort,get_cohort_totals_by_metric
-from users import ensure_user_data_initialized,get_language_list,get_country_list
+from metrics import get_multi_app_cohort,multi_app_totals,get_filtered_cohort,get_filtered_cohort_size,get_filtered_cohort_totals,get_cohort_funnel
+from users import ensure_user_data_initialized,get_language_list,get_country_list,add_unloaded_columns
+import datasets
 from settings import initialize
 
 initialize()
@@ -40,26 +41,10 @@ if (len(countries_list) and len(daterange) == 2 ):
             "Game Completed",
         ]
 
-        # Start totals at zero
-        totals = {s: 0 for s in stats}
-
-        # All *real* apps (exclude the synthetic "All" option)
+        # All *real* apps (exclude the synthetic "All" option), evaluated concurrently
         real_apps = [a for a in distinct_apps if a != "All"]
-
-        for app_name in real_apps:
-            # app_name is a string; metrics helper expects same shape
-            app_stats, counts = get_funnel_step_counts_for_app(
-                app=[app_name],  # keep consistent with existing functions
-                daterange=daterange,
-                language=language,
-                countries_list=countries_list,
-                funnel_size=funnel_size,
-            )
-
-            # Just in case, only sum the stats we’re actually plotting
-            for s in stats:
-                if s in counts:
-                    totals[s] += counts[s]
+        multi_app_cohort = get_multi_app_cohort(real_apps, daterange, language, countries_list)
+        totals = multi_app_totals(multi_app_cohort)
 
         # Build counts in the right order
         funnel_step_counts = [totals[s] for s in stats]
@@ -114,17 +99,13 @@ if (len(countries_list) and len(daterange) == 2 ):
 
     # --- SINGLE APP MODE  ---
     else:
-        user_cohort_df, user_cohort_df_LR = get_filtered_cohort(
-            app=app,
-            daterange=daterange,
-            language=language,
-            countries_list=countries_list,
-        )
+        # Counted from the indexes, before the cohort itself is built
+        cohort_size = get_filtered_cohort_size(app, daterange, language, countries_list)
+        st.caption(f"{cohort_size:,} users match these filters")
 
-        LR = get_cohort_totals_by_metric(user_cohort_df_LR if user_cohort_df_LR is not None else user_cohort_df, "LR")
-        LA = get_cohort_totals_by_metric(user_cohort_df, "LA")
-        RA = get_cohort_totals_by_metric(user_cohort_df, "RA")
-        GC = get_cohort_totals_by_metric(user_cohort_df, "GC")
+        # Tiles and funnel are summed from the funnel cube - user rows are only read for the download
+        totals = get_filtered_cohort_totals(app, daterange, language, countries_list, ("LR", "LA", "RA", "GC"))
+        LR, LA, RA, GC = totals["LR"], totals["LA"], totals["RA"], totals["GC"]
 
         col1.metric("Learners Reached", prettify(LR))
         col2.metric("Learners Acquired", prettify(LA))
@@ -137,19 +118,32 @@ if (len(countries_list) and len(daterange) == 2 ):
             funnel_size = "large"
 
         create_funnels_by_cohort(
-            cohort_df=user_cohort_df,         # main progress cohort
-            cohort_df_LR=user_cohort_df_LR,   # app_launch cohort for LR only
+            cohort_df=None,
+            funnel=get_cohort_funnel(
+                app, daterange, language, countries_list, min_funnel=(funnel_size == "compact")
+            ),
             key_prefix="s5",
             funnel_size=funnel_size,
             app=app,
         )
 
-        csv = ui.convert_for_download(user_cohort_df)
-        st.download_button(
-            label="Download",
-            data=csv,
-            file_name="user_cohort_list.csv",
-            key="s6",
-            icon=":material/download:",
-            mime="text/csv",
-        )
+        # Only the columns the metrics use are kept in memory, so the full-width
+        # export is fetched on request rather than on every rerun
+        if st.button("Prepare download", key="s6-prepare", icon=":material/table:"):
+            user_cohort_df, _ = get_filtered_cohort(
+                app=app,
+                daterange=daterange,
+                language=language,
+                countries_list=countries_list,
+            )
+            dataset = datasets.UNITY_USER_PROGRESS if "Unity" in app else datasets.CR_USER_PROGRESS
+            csv = ui.convert_for_download(add_unloaded_columns(user_cohort_df, dataset))
+            st.download_button(
+                label="Download",
+                data=csv,
+                file_name="user_cohort_list.csv",
+                key="s6",
+                icon=":material/download:",
+                mime="text/csv",
+                on_click="ignore",
+            )
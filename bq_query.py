@@ -0,0 +1,110 @@
+import pandas as pd
+import pyarrow as pa
+
+import settings
+
+# Shared query runner: every BigQuery read in the dashboard goes through a
+# backend that yields Arrow record batches, and is converted to pandas from
+# Arrow with typed columns (strings stay Arrow-backed, numbers are handed
+# over without a copy where Arrow allows it).
+#
+# BigQueryBackend streams results over the BigQuery Storage Read API when
+# google-cloud-bigquery-storage is importable, and falls back to the REST
+# pages otherwise.  LocalBackend answers queries from canned frames, so the
+# loaders can be run and benchmarked without a network:
+#
+#     bq_query.set_default_backend(bq_query.LocalBackend({"active_countries": df}))
+
+
+class BigQueryBackend:
+    def __init__(self, client, credentials=None):
+        self.client = client
+        self.credentials = credentials
+        self._bqstorage_client = None
+
+    def bqstorage_client(self):
+        """A BigQuery Storage read client, or None to read the REST pages."""
+        if self._bqstorage_client is None:
+            try:
+                from google.cloud import bigquery_storage
+            except ImportError:
+                return None
+            self._bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=self.credentials)
+        return self._bqstorage_client
+
+    def record_batches(self, sql):
+        rows = self.client.query(sql).result()
+        return rows.to_arrow_iterable(bqstorage_client=self.bqstorage_client())
+
+
+class LocalBackend:
+    """
+    Answers queries without BigQuery.  `results` is either a function
+    sql -> DataFrame / pyarrow Table, or a {name: frame} dict whose first
+    name found in the SQL (e.g. the table name) picks the result.
+    """
+
+    def __init__(self, results, batch_size=64_000):
+        self.results = results
+        self.batch_size = batch_size
+
+    def record_batches(self, sql):
+        if callable(self.results):
+            result = self.results(sql)
+        else:
+            result = next((frame for name, frame in self.results.items() if name in sql), None)
+            if result is None:
+                raise KeyError(f"No local result for query: {sql.strip()[:200]}")
+        if isinstance(result, pd.DataFrame):
+            result = pa.Table.from_pandas(result, preserve_index=False)
+        return iter(result.to_batches(max_chunksize=self.batch_size))
+
+
+default_backend = None
+
+
+def set_default_backend(backend):
+    """Route every query through `backend` (None goes back to BigQuery)."""
+    global default_backend
+    default_backend = backend
+
+
+def get_default_backend():
+    global default_backend
+    if default_backend is None:
+        credentials, client = settings.get_gcp_credentials()
+        default_backend = BigQueryBackend(client, credentials)
+    return default_backend
+
+
+def to_pandas(table):
+    # Strings become Arrow-backed string columns instead of Python objects
+    return table.to_pandas(
+        types_mapper={pa.string(): pd.StringDtype("pyarrow"), pa.large_string(): pd.StringDtype("pyarrow")}.get,
+        split_blocks=True,
+        self_destruct=True,
+    )
+
+
+def query_batches(sql, backend=None):
+    """Iterator of pyarrow RecordBatches for `sql`."""
+    return (backend or get_default_backend()).record_batches(sql)
+
+
+def query_dataframes(sql, backend=None):
+    """
+    The result of `sql` as a stream of DataFrames, one per record batch, so
+    a large result is converted (and can be reduced) a batch at a time.
+    """
+    for batch in query_batches(sql, backend):
+        yield to_pandas(pa.Table.from_batches([batch]))
+
+
+def query_dataframe(sql, backend=None):
+    """The whole result of `sql` as one DataFrame (an empty one for no rows)."""
+    batches = list(query_batches(sql, backend))
+    if not batches:
+        return pd.DataFrame()
+    table = pa.Table.from_batches(batches)
+    del batches  # so self_destruct can release each column once converted
+    return to_pandas(table)
@@ -1,9 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from rich import print as print
 import campaigns
 import metrics
 import asyncio
+import re
+import settings
+import bq_query
+import marketing_store
 from pyinstrument import Profiler
 
 
@@ -11,103 +16,171 @@ from pyinstrument import Profiler
 # both language and country through a naming convention.  So we are only collecting
 # and reporting on daily campaign segment data from that day forward.
 
-# Combined function to fetch Google and Facebook campaign data concurrently
-
-async def get_campaign_data():
+# Google Ads Query
+GOOGLE_ADS_QUERY = """
+    SELECT
+        metrics.campaign_id,
+        metrics.segments_date as segment_date,
+        campaigns.campaign_name,
+        metrics_cost_micros as cost,
+        campaigns.campaign_start_date,
+        campaigns.campaign_end_date, 
+        "Google" as source
+    FROM dataexploration-193817.marketing_data.p_ads_CampaignStats_6687569935 as metrics
+    INNER JOIN dataexploration-193817.marketing_data.ads_Campaign_6687569935 as campaigns
+    ON metrics.campaign_id = campaigns.campaign_id
+    AND metrics.segments_date >= '{since}'
+    GROUP BY 1,2,3,4,5,6
+"""
+
+# Columns both ads queries return
+MARKETING_COLUMNS = [
+    "campaign_id", "segment_date", "campaign_name", "cost",
+    "campaign_start_date", "campaign_end_date", "source",
+]
+
+# Text columns of the campaign rows, Arrow-backed as bq_query.to_pandas returns them
+MARKETING_STRING_COLUMNS = ["campaign_name", "source"]
+
+# Facebook Ads Query
+FACEBOOK_ADS_QUERY = """
+    SELECT 
+        d.campaign_id,
+        d.data_date_start as segment_date,
+        d.campaign_name,
+        d.spend as cost,
+        d.start_time as campaign_start_date, 
+        d.end_time as campaign_end_date,
+        "Facebook" as source
+    FROM dataexploration-193817.marketing_data.facebook_ads_data as d
+    WHERE d.data_date_start >= '{since}'
+    ORDER BY d.data_date_start DESC;
+"""
+
+
+def normalize_marketing_dtypes(rows):
+    """
+    Campaign rows with the dtypes a fetch produces (bq_query.to_pandas), however
+    they were assembled: rows read back from the store come out of parquet as
+    object or python-backed strings, and concatenating them with fetched rows
+    would otherwise decide the dtype by which path ran.
+    """
+    return rows.astype({col: pd.StringDtype("pyarrow") for col in MARKETING_STRING_COLUMNS})
+
+
+def prepare_google_ads_data(google_ads_data):
+    google_ads_data["campaign_id"] = google_ads_data["campaign_id"].astype(str).str.replace(",", "")
+    google_ads_data["cost"] = google_ads_data["cost"].divide(1000000).round(2)
+    google_ads_data["segment_date"] = pd.to_datetime(google_ads_data["segment_date"])
+    return google_ads_data
+
+
+def prepare_facebook_ads_data(facebook_ads_data):
+    # Same key types as the Google rows, so stored and fetched rows match on upsert
+    facebook_ads_data["campaign_id"] = facebook_ads_data["campaign_id"].astype(str)
+    facebook_ads_data["segment_date"] = pd.to_datetime(facebook_ads_data["segment_date"])
+    return facebook_ads_data
+
+
+# Combined function to fetch Google and Facebook campaign data concurrently.
+# backend defaults to BigQuery (bq_query.get_default_backend); a
+# bq_query.LocalBackend of canned frames runs the whole flow offline.
+async def get_campaign_data(backend=None, store_dir=None, incremental=None):
     p = Profiler(async_mode="disabled")
     with p:
-        bq_client = st.session_state.bq_client
-
-        # Helper function to run BigQuery queries asynchronously
-        async def run_query(query):
-            return await asyncio.to_thread(bq_client.query(query).to_dataframe)
-
-        # Google Ads Query
-        google_ads_query = """
-            SELECT
-                metrics.campaign_id,
-                metrics.segments_date as segment_date,
-                campaigns.campaign_name,
-                metrics_cost_micros as cost,
-                campaigns.campaign_start_date,
-                campaigns.campaign_end_date, 
-                "Google" as source
-            FROM dataexploration-193817.marketing_data.p_ads_CampaignStats_6687569935 as metrics
-            INNER JOIN dataexploration-193817.marketing_data.ads_Campaign_6687569935 as campaigns
-            ON metrics.campaign_id = campaigns.campaign_id
-            AND metrics.segments_date >= '2024-05-01'
-            GROUP BY 1,2,3,4,5,6
-        """
-
-        # Facebook Ads Query
-        facebook_ads_query = """
-            SELECT 
-                d.campaign_id,
-                d.data_date_start as segment_date,
-                d.campaign_name,
-                d.spend as cost,
-                d.start_time as campaign_start_date, 
-                d.end_time as campaign_end_date,
-                "Facebook" as source
-            FROM dataexploration-193817.marketing_data.facebook_ads_data as d
-            WHERE d.data_date_start >= '2024-05-01'
-            ORDER BY d.data_date_start DESC;
-        """
-
-        # Run both queries concurrently using asyncio.gather
+        if incremental is None:
+            incremental = marketing_store.MARKETING_INCREMENTAL
+
+        # Only rows from the watermark are queried; they replace the stored rows for the same keys
+        async def refresh_source(source, query, prepare):
+            stored = marketing_store.read_rows(source, store_dir) if incremental else None
+            since = marketing_store.watermark(stored)
+            sql = query.format(since=since.isoformat())
+
+            # Streamed: each record batch is converted and prepared on its own
+            def fetch():
+                return [prepare(df) for df in bq_query.query_dataframes(sql, backend)]
+
+            frames = await asyncio.to_thread(fetch)
+            fetched = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=MARKETING_COLUMNS)
+            rows = normalize_marketing_dtypes(marketing_store.upsert(stored, fetched))
+            if incremental:
+                marketing_store.write_rows(rows, source, store_dir)
+            settings.get_logger().info(
+                f"{source} ads: fetched {len(fetched):,} rows since {since}, {len(rows):,} in total"
+            )
+            return rows
+
+        # Run both sources concurrently using asyncio.gather
         google_ads_data, facebook_ads_data = await asyncio.gather(
-            run_query(google_ads_query),
-            run_query(facebook_ads_query)
+            refresh_source("google", GOOGLE_ADS_QUERY, prepare_google_ads_data),
+            refresh_source("facebook", FACEBOOK_ADS_QUERY, prepare_facebook_ads_data),
         )
-
-        # Process Google Ads Data
-        google_ads_data["campaign_id"] = google_ads_data["campaign_id"].astype(str).str.replace(",", "")
-        google_ads_data["cost"] = google_ads_data["cost"].divide(1000000).round(2)
-  #      google_ads_data["segment_date"] = pd.to_datetime
-        google_ads_data["segment_date"] = pd.to_datetime(google_ads_data["segment_date"])
     p.print(color="red")
     return google_ads_data, facebook_ads_data
 
-@st.cache_data(ttl="1d", show_spinner=False)
+
+@st.cache_data(ttl="10m", show_spinner=False)
+def get_marketing_data_version():
+    """
+    Latest segment date in the Google and Facebook campaign tables, e.g.
+    "google=2026-10-17|facebook=2026-10-17".  The version token for the
+    marketing data: caches take it as an argument instead of expiring on a
+    ttl.  Only two MAX() aggregates are queried - the short ttl is how often.
+    """
+    sql_query = """
+        SELECT
+            (SELECT MAX(segments_date) FROM dataexploration-193817.marketing_data.p_ads_CampaignStats_6687569935) AS google,
+            (SELECT MAX(data_date_start) FROM dataexploration-193817.marketing_data.facebook_ads_data) AS facebook
+    """
+    row = bq_query.query_dataframe(sql_query).iloc[0]
+    return f"google={row['google']}|facebook={row['facebook']}"
+
+# Campaign names follow "[anything without dashes]: [language] - [country] Campaign".
+# One pass finds both parts:
+#   language - after the first ":" that is followed by text and then a "-"
+#   country  - everything after the first "-", cut before the last "Campaign"
+CAMPAIGN_NAME_RE = re.compile(
+    r"(?=(?:[\s\S]*?:\s*(?P<language>[^-]+?)\s*-)?)"
+    r"(?:[^-]*-\s*(?:(?P<campaign_country>.*)Campaign|(?P<country>.*)))?"
+)
+
+# campaign_name -> (country, language).  Kept for the life of the process:
+# there are only a few hundred distinct names, and each refresh adds a handful.
+campaign_name_parts = {}
+
+
+def parse_campaign_name(name):
+    """(country, app_language) of one campaign name, None where the name has no such part."""
+    parts = campaign_name_parts.get(name)
+    if parts is None:
+        if not isinstance(name, str):
+            return None, None
+        match = CAMPAIGN_NAME_RE.match(name)
+        country = match.group("campaign_country")
+        if country is None:
+            country = match.group("country")
+        language = match.group("language")
+        parts = (
+            None if country is None else country.strip(),
+            None if language is None else language.strip().lower(),
+        )
+        campaign_name_parts[name] = parts
+    return parts
+
+
 # Looks for the string following the dash and makes that the associated country.
 # This requires a strict naming convention of "[anything without dashes] - [country]]"
 def add_country_and_language(df):
+    # Parse each distinct name once and broadcast back through the factorized codes
+    codes, names = pd.factorize(df["campaign_name"])
+    parts = [parse_campaign_name(name) for name in names]
+    countries = np.array([country for country, _ in parts] + [None], dtype=object)
+    languages = np.array([language for _, language in parts] + [None], dtype=object)
 
-    # Define the regex patterns
-    country_regex_pattern = r"-\s*(.*)"
-    language_regex_pattern = r":\s*([^-]+?)\s*-"
-    campaign_regex_pattern = r"\s*(.*)Campaign"
-
-    # Extract the country
-    df["country"] = (
-        df["campaign_name"].str.extract(country_regex_pattern)[0].str.strip()
-    )
-
-    # Remove the word "Campaign" if it exists in the country field
-    extracted = df["country"].str.extract(campaign_regex_pattern)
-    df["country"] = extracted[0].fillna(df["country"]).str.strip()
-
-    # Extract the language
-    df["app_language"] = (
-        df["campaign_name"].str.extract(language_regex_pattern)[0].str.strip()
-    )
-
-    # Set default values to None where there's no match
-    country_contains_pattern = r"-\s*(?:.*)"
-    language_contains_pattern = r":\s*(?:[^-]+?)\s*-"
-
-    df["country"] = df["country"].where(
-        df["campaign_name"].str.contains(
-            country_contains_pattern, regex=True, na=False
-        ),
-        None,
-    )
-    df["app_language"] = df["app_language"].where(
-        df["campaign_name"].str.contains(
-            language_contains_pattern, regex=True, na=False
-        ),
-        None,
-    ).str.lower()
+    # Missing names have code -1, which picks the trailing None
+    df["country"] = countries[codes]
+    df["app_language"] = languages[codes]
 
     return df
 
@@ -150,72 +223,114 @@ def rollup_campaign_data(df):
     return df
 
 
-@st.cache_data(ttl="1d", show_spinner=False)
-def get_campaigns_by_date(daterange):
-    df_campaigns_all = st.session_state.df_campaigns_all
-
-    conditions = [
-        f"@daterange[0] <= segment_date <= @daterange[1]",
-    ]
+class CampaignSpendStore:
+    """
+    Daily campaign spend, built once per marketing data refresh.
+
+    Cost is held as one dense array per campaign (a row per campaign_id, a
+    column per day) with running totals, so the spend of any campaign over
+    [start, end] is cum_cost[:, end + 1] - cum_cost[:, start].  Each
+    campaign's name and other attributes are resolved once from its newest
+    daily row, the way rollup_campaign_data resolved them per range.
+    """
+
+    def __init__(self, df_campaigns_all):
+        rows = df_campaigns_all.reset_index(drop=True)
+        segment_date = pd.to_datetime(rows["segment_date"]).dt.normalize()
+        rows = rows[segment_date.notna() & rows["campaign_id"].notna()]
+        segment_date = segment_date[rows.index]
+        self.rows = rows.reset_index(drop=True)
+
+        codes, campaign_ids = pd.factorize(self.rows["campaign_id"])
+        self.first_day = segment_date.min() if len(segment_date) else pd.Timestamp(0)
+        days = (segment_date - self.first_day).dt.days.to_numpy()
+        self.n_days = int(days.max()) + 1 if len(days) else 0
+        n_campaigns = len(campaign_ids)
+
+        # Dense (campaign, day) cost and row counts; the leading zero column makes every range a plain difference
+        cells = codes * self.n_days + days
+        size = n_campaigns * self.n_days
+        cost = np.bincount(cells, weights=self.rows["cost"].fillna(0).to_numpy(dtype=float), minlength=size)
+        n_rows = np.bincount(cells, minlength=size)
+        self.cum_cost = np.zeros((n_campaigns, self.n_days + 1))
+        self.cum_cost[:, 1:] = cost.reshape(n_campaigns, self.n_days).cumsum(axis=1)
+        self.cum_rows = np.zeros((n_campaigns, self.n_days + 1), dtype=np.int32)
+        self.cum_rows[:, 1:] = n_rows.reshape(n_campaigns, self.n_days).cumsum(axis=1)
+
+        # Newest non-empty value of every attribute, in campaign code order
+        attributes = [c for c in self.rows.columns if c not in ("segment_date", "cost")]
+        newest_first = self.rows.assign(segment_date=segment_date.to_numpy()).sort_values(
+            "segment_date", ascending=False, kind="stable"
+        )
+        self.campaigns = (
+            newest_first.groupby("campaign_id", sort=False)[[c for c in attributes if c != "campaign_id"]]
+            .first()
+            .reindex(pd.Index(campaign_ids, name="campaign_id"))
+            .reset_index()
+        )
+        self.columns = [c for c in self.rows.columns if c != "segment_date"]
 
-    query = " and ".join(conditions)
-    df = df_campaigns_all.query(query)
+    def day_bounds(self, daterange):
+        """Column bounds (lo, hi) of the cumulative arrays for a [start, end] daterange."""
+        start = (pd.Timestamp(daterange[0]).normalize() - self.first_day).days
+        end = (pd.Timestamp(daterange[1]).normalize() - self.first_day).days
+        lo = min(max(start, 0), self.n_days)
+        hi = min(max(end + 1, 0), self.n_days)
+        return lo, max(lo, hi)
 
-    df = campaigns.rollup_campaign_data(df)
-    df = campaigns.add_google_button_clicks(df, daterange)
+    def campaign_spend(self, daterange):
+        """(cost, number of daily rows) per campaign over daterange, in campaign code order."""
+        lo, hi = self.day_bounds(daterange)
+        return self.cum_cost[:, hi] - self.cum_cost[:, lo], self.cum_rows[:, hi] - self.cum_rows[:, lo]
 
-    return df
+    def campaigns_between(self, daterange):
+        """One row per campaign with spend rows in daterange, its cost summed over the range."""
+        cost, n_rows = self.campaign_spend(daterange)
+        active = n_rows > 0
+        df = self.campaigns[active].assign(cost=cost[active])
+        return df[self.columns].reset_index(drop=True)
 
 
-@st.cache_data(ttl="1d", show_spinner=True)
-def build_campaign_table(df, daterange):
+def get_campaigns_by_date(daterange):
+    """
+    Campaigns with spend in daterange rolled up to one row each, read from
+    the spend store of the current marketing data snapshot.
+    """
+    return settings.get_campaign_spend_store().campaigns_between(daterange)
 
-    df = (
-        df.groupby(["country", "app_language"], as_index=False)
-        .agg(
-            {
-                "cost": "sum",
-            }
-        )
-        .round(2)
-    )
-
-    stats = ["LR", "PC", "LA","RA"]
-    for idx, row in df.iterrows():
-        country_list = [row["country"]]
-        language = [row["app_language"].lower()]
-
-        for stat in stats:
-
-            result = metrics.get_totals_by_metric(
-                countries_list=country_list,
-                language=language,
-                daterange=daterange,
-                stat=stat,
-                app="CR",
-            )
-            df.at[idx, stat] = result
-            df.at[idx, stat + "C"] = (
-                (df.at[idx, "cost"] / result).round(2) if result != 0 else 0
-            )
-            if stat == "LR":
-                LR = result
-            elif stat == "PC":
-                PC = result
-            elif stat == "LA":
-                LA = result
-            else:
-                RA = result
-        try:
-            LA_LR = round(LA / LR, 2) * 100
-            PC_LR = round(PC / LR, 2) * 100
-            RA_LR = round(RA / LR, 2) * 100
-        except ZeroDivisionError:
-            LA_LR = 0
-            PC_LR = 0
-            RA_LR = 0
-        df.at[idx, "PC_LR %"] = PC_LR
-        df.at[idx, "LA_LR %"] = LA_LR
-        df.at[idx, "RA_LR %"] = RA_LR
 
-    return df
+def build_campaign_table(df, daterange):
+    """
+    Campaign cost per (country, app_language) joined to the CR funnel counts
+    of the same users, with the cost per LR/PC/LA/RA and the PC/LA/RA share
+    of LR.  The counts for every key come from one grouped pass
+    (metrics.get_filtered_cohort_totals_by_group), not one cohort per row.
+    """
+    return build_versioned_campaign_table(df, daterange, metrics.get_cohort_version())
+
+
+# Keyed on the version of the user data the counts are cut from, so a new
+# run_date export replaces the cached tables instead of them serving old counts
+@st.cache_data(max_entries=32, show_spinner=True)
+def build_versioned_campaign_table(df, daterange, version):
+    keys = ["country", "app_language"]
+    stats = ["LR", "PC", "LA", "RA"]
+
+    df = df.groupby(keys, as_index=False).agg({"cost": "sum"}).round(2)
+
+    # Campaign languages are matched lower-cased; campaigns without a country
+    # or language can't match any users
+    counts = metrics.get_filtered_cohort_totals_by_group("CR", daterange, keys, stats)
+    counts = counts.rename(columns={"app_language": "language_key"})
+    df["language_key"] = df["app_language"].str.lower()
+    df = df.merge(counts, on=["country", "language_key"], how="left").drop(columns="language_key")
+    df[stats] = df[stats].fillna(0)
+
+    for stat in stats:
+        df[stat + "C"] = (df["cost"] / df[stat]).round(2).where(df[stat] != 0, 0)
+
+    LR = df["LR"].where(df["LR"] != 0)
+    for stat in ["PC", "LA", "RA"]:
+        df[stat + "_LR %"] = (df[stat] * 100 / LR).round().fillna(0)
+
+    return df[keys + ["cost"] + [c for stat in stats for c in (stat, stat + "C")] + ["PC_LR %", "LA_LR %", "RA_LR %"]]
@@ -0,0 +1,279 @@
+import dataclasses
+import functools
+import hashlib
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Cohort filters, fingerprints and the in-process memo for cohorts and the
+# metrics computed from them.
+#
+# st.cache_data hashes every DataFrame argument on every call - for a cohort
+# of millions of rows that can cost more than the metric itself, even on a
+# hit.  Instead, metrics.get_filtered_cohort registers each cohort frame it
+# returns together with a fingerprint of what it is: the user data version
+# plus its CohortFilter.  Functions decorated with @memoize key on
+# that fingerprint, so a hit costs a dict lookup.  Frames that were never
+# registered (e.g. built by hand) are simply computed without the memo.
+
+METRIC_CACHE_MAX_BYTES = int(float(os.environ.get("METRIC_CACHE_MAX_MB", "512")) * 1024**2)
+
+ALL = ("All",)
+
+
+@dataclass(frozen=True)
+class CohortFilter:
+    """
+    A cohort selection in one canonical, hashable form - the only key the
+    cohort and metric caches use.  Build it with from_selection() from
+    whatever shapes the pages pass: "CR" or ["CR"], countries in selection
+    order or with duplicates, dates as date, datetime or Timestamp.
+    """
+
+    apps: tuple = ALL
+    languages: tuple = ALL
+    countries: tuple = ALL
+    start: pd.Timestamp = None
+    end: pd.Timestamp = None
+    funnel_size: str = None
+
+    @classmethod
+    def from_selection(cls, app=None, daterange=None, language=None, countries_list=None, funnel_size=None):
+        start = end = None
+        if daterange is not None and len(daterange) == 2:
+            start, end = pd.Timestamp(daterange[0]), pd.Timestamp(daterange[1])
+        return cls(
+            apps=_selection(app),
+            languages=_selection(language),
+            countries=_selection(countries_list),
+            start=start,
+            end=end,
+            funnel_size=funnel_size,
+        )
+
+    def without_funnel_size(self):
+        return dataclasses.replace(self, funnel_size=None)
+
+    # The filter back in the shapes the metric functions take
+    @property
+    def app(self):
+        return list(self.apps)
+
+    @property
+    def daterange(self):
+        return None if self.start is None else [self.start, self.end]
+
+    @property
+    def language(self):
+        return list(self.languages)
+
+    @property
+    def countries_list(self):
+        return list(self.countries)
+
+
+def _selection(values):
+    """Sorted, de-duplicated tuple; nothing selected is the same as ["All"]."""
+    values = [values] if isinstance(values, str) else list(values or [])
+    return tuple(sorted(set(values))) if values else ALL
+
+
+class CohortHandle:
+    """
+    What a registered cohort frame is: the CohortFilter it was cut with, the
+    user data version it was cut from, and which frame ("users" or "LR").
+    """
+
+    def __init__(self, version, cohort_filter, role="users"):
+        self.version = version
+        self.cohort_filter = cohort_filter.without_funnel_size()
+        self.role = role
+        raw = repr((version, self.cohort_filter, role))
+        self.fingerprint = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return f"CohortHandle({self.fingerprint[:12]}, {self.role}, {self.cohort_filter})"
+
+
+# id(frame) -> (weakref to the frame, handle).  Entries go away with the frame.
+_handles = {}
+_handles_lock = threading.Lock()
+
+
+def register(df, handle):
+    """Attach `handle` to the frame object `df` and return df.  Registered frames must not be modified in place."""
+    key = id(df)
+
+    def forget(_, key=key):
+        with _handles_lock:
+            entry = _handles.get(key)
+            if entry is not None and entry[0]() is None:
+                del _handles[key]
+
+    with _handles_lock:
+        _handles[key] = (weakref.ref(df, forget), handle)
+    return df
+
+
+def get_handle(df):
+    """The handle registered for this exact frame object, or None."""
+    with _handles_lock:
+        entry = _handles.get(id(df))
+    if entry is None or entry[0]() is not df:
+        return None
+    return entry[1]
+
+
+def _arg_key(value):
+    """Cache-key part for one argument, or raise LookupError for an unregistered frame."""
+    if isinstance(value, CohortFilter):
+        return value
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        handle = get_handle(value)
+        if handle is None:
+            raise LookupError("unregistered frame")
+        return ("cohort", handle.fingerprint)
+    if isinstance(value, (list, tuple)):
+        return tuple(_arg_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _arg_key(v)) for k, v in value.items()))
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def _size_of(value):
+    # Shallow on purpose: cohort frames point at the strings of the shared
+    # user frames, so only their own arrays are extra memory
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True))
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+def _detach(value):
+    """
+    Return a cached result without handing out the cached object itself:
+    frames come back as shallow copies, which copy-on-write keeps from
+    writing through to the cached one.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    if isinstance(value, tuple):
+        return tuple(_detach(v) for v in value)
+    if isinstance(value, list):
+        return [_detach(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _detach(v) for k, v in value.items()}
+    return value
+
+
+class MetricMemo:
+    """
+    LRU of cohort and metric results, evicting least recently used entries
+    past max_bytes.  Counts hits and misses per function - including hits on
+    entries another page computed - and logs the hit rates every LOG_EVERY lookups.
+    """
+
+    LOG_EVERY = 200
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (result, size, page that computed it)
+        self.total_bytes = 0
+        self.stats = {}  # function name -> [hits, misses, cross-page hits]
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, result, page=None):
+        size = _size_of(result)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size, page)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def record(self, name, hit, cross_page=False):
+        with self.lock:
+            counts = self.stats.setdefault(name, [0, 0, 0])
+            counts[0 if hit else 1] += 1
+            counts[2] += cross_page
+            self.lookups += 1
+            if self.lookups % self.LOG_EVERY:
+                return
+            summary = ", ".join(
+                f"{name} {hits}/{hits + misses} hits ({cross} cross-page)"
+                for name, (hits, misses, cross) in sorted(self.stats.items())
+            )
+            entries, total_bytes = len(self.entries), self.total_bytes
+        # Imported here: settings -> campaigns -> metrics imports this module
+        import settings
+        settings.get_logger().info(
+            f"Cohort cache: {summary}; {entries} entries, {total_bytes / 1024**2:.1f} MB"
+        )
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+metric_memo = MetricMemo(METRIC_CACHE_MAX_BYTES)
+
+
+def current_page():
+    """The page script this rerun is for, so hits can be told apart by page."""
+    ctx = get_script_run_ctx()
+    return ctx.page_script_hash if ctx is not None else None
+
+
+def memoize(func):
+    """
+    Memoize a cohort or metric function in metric_memo, keyed on its
+    CohortFilter arguments, the fingerprints of its cohort frame arguments
+    and the values of the others.  Calls with a frame that has no handle
+    run uncached.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            key = (func.__module__, func.__qualname__, _arg_key(args), _arg_key(kwargs))
+        except LookupError:
+            return func(*args, **kwargs)
+
+        page = current_page()
+        entry = metric_memo.get(key)
+        if entry is None:
+            result = func(*args, **kwargs)
+            metric_memo.put(key, result, page)
+            metric_memo.record(func.__qualname__, hit=False)
+            return _detach(result)
+
+        metric_memo.record(func.__qualname__, hit=True, cross_page=entry[2] != page)
+        return _detach(entry[0])
+
+    return wrapper
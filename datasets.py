@@ -0,0 +1,64 @@
+# Declared schema for the nightly user parquet exports.
+#
+# Each dataset starts with the columns the cleaning in users.init_user_data
+# needs.  Modules that read the cleaned frames add the columns they use with
+# register_columns() at import time, and the loader projects the parquet read
+# down to that set.  Columns nobody registered are only read on demand
+# (e.g. for the cohort CSV download).
+
+CR_USER_PROGRESS = "cr_user_progress"
+UNITY_USER_PROGRESS = "unity_user_progress"
+CR_APP_LAUNCH = "cr_app_launch"
+
+USER_DATASETS = {
+    CR_USER_PROGRESS: {
+        "pattern": "user_data_parquet_cache/cr_user_progress/run_date=*/cr_user_progress_*.parquet",
+        # Grain of the raw export - used to join wide columns back onto cleaned rows
+        "row_key": ["cr_user_id", "country", "app_language"],
+        "columns": {
+            "cr_user_id", "user_pseudo_id", "first_open", "last_event_date",
+            "country", "app_language", "app", "furthest_event",
+            "max_user_level", "active_span",
+        },
+    },
+    UNITY_USER_PROGRESS: {
+        "pattern": "user_data_parquet_cache/unity_user_progress/run_date=*/unity_user_progress_*.parquet",
+        "row_key": ["user_pseudo_id"],
+        "columns": {
+            "user_pseudo_id", "first_open", "la_date", "last_event_date",
+            "max_user_level",
+        },
+    },
+    CR_APP_LAUNCH: {
+        "pattern": "user_data_parquet_cache/cr_app_launch/run_date=*/cr_app_launch_*.parquet",
+        "row_key": ["cr_user_id", "user_pseudo_id", "country", "app_language"],
+        "columns": {
+            "cr_user_id", "user_pseudo_id", "first_open", "country", "app_language",
+        },
+    },
+}
+
+
+def register_columns(columns, datasets=None):
+    """
+    Declare that a consumer reads `columns` from the given datasets (all user
+    datasets by default).  Columns a dataset does not have are ignored at load time.
+    """
+    for name in datasets or USER_DATASETS:
+        USER_DATASETS[name]["columns"].update(columns)
+
+
+def get_columns(name):
+    """Sorted tuple of registered columns - hashable so it can key st.cache_data."""
+    return tuple(sorted(USER_DATASETS[name]["columns"]))
+
+
+# Funnel event ranking of furthest_event and the bits of the funnel_flags
+# column.  Kept here rather than in users so metrics can read them at import
+# time without going through the users -> settings -> campaigns -> metrics
+# import cycle.
+EVENT_ORDER = ["download_completed", "tapped_start", "selected_level", "puzzle_completed", "level_completed"]
+
+FUNNEL_FLAG_LA = 1  # Learners Acquired: max_user_level >= 1
+FUNNEL_FLAG_RA = 2  # Readers Acquired: max_user_level >= 25
+FUNNEL_FLAG_GC = 4  # Game Completed: max_user_level >= 1 and gpc >= 90
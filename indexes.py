@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+# Lightweight indexes built once per shared user dataset (see
+# users.build_shared_user_data) so cohort filters only touch the rows they need.
+
+
+class FirstOpenIndex:
+    """
+    Row bounds for first_open ranges over a frame sorted by first_open
+    (NaT last).  A daterange becomes a contiguous iloc slice found by binary
+    search instead of two boolean masks over every row.
+    """
+
+    def __init__(self, first_open):
+        values = first_open.to_numpy(dtype="datetime64[ns]")
+        n_valid = int((~np.isnat(values)).sum())
+        values = values[:n_valid]
+        if np.isnat(values).any() or (values[1:] < values[:-1]).any():
+            raise ValueError("FirstOpenIndex needs a frame sorted by first_open with NaT last")
+        self.values = values
+
+    def bounds(self, start, end):
+        """(lo, hi) such that rows lo:hi have start <= first_open <= end."""
+        lo = np.searchsorted(self.values, pd.Timestamp(start).to_datetime64(), side="left")
+        hi = np.searchsorted(self.values, pd.Timestamp(end).to_datetime64(), side="right")
+        return int(lo), int(max(lo, hi))
+
+
+class DimensionIndex:
+    """
+    Inverted index over one dimension column: the sorted row positions of
+    every value.  Country / language / app filters resolve to row ids by
+    merging these lists, so the column itself is never scanned.
+    """
+
+    def __init__(self, column):
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype("category")
+        codes = column.cat.codes.to_numpy()
+        dtype = np.int32 if len(codes) < 2**31 else np.int64
+
+        # A stable sort by code groups the row ids per value, each group ascending
+        order = np.argsort(codes, kind="stable").astype(dtype)
+        n_missing = int((codes < 0).sum())
+        counts = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories))
+
+        self.row_ids = order[n_missing:]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.positions = {value: i for i, value in enumerate(column.cat.categories)}
+
+    def rows(self, values, lo=0, hi=None):
+        """Sorted row ids within lo:hi whose value is one of `values`."""
+        parts = []
+        for value in dict.fromkeys(values):
+            i = self.positions.get(value)
+            if i is None:
+                continue
+            ids = self.row_ids[self.offsets[i]:self.offsets[i + 1]]
+            if lo or hi is not None:
+                end = len(ids) if hi is None else np.searchsorted(ids, hi)
+                ids = ids[np.searchsorted(ids, lo):end]
+            parts.append(ids)
+
+        if not parts:
+            return np.empty(0, dtype=self.row_ids.dtype)
+        # Values never share a row, so the union is a plain concatenate + sort
+        return parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+
+
+def intersect_rows(row_id_arrays):
+    """Row ids present in every array (each sorted and unique), smallest first."""
+    arrays = sorted(row_id_arrays, key=len)
+    result = arrays[0]
+    for ids in arrays[1:]:
+        if not len(result):
+            break
+        result = np.intersect1d(result, ids, assume_unique=True)
+    return result
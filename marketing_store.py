@@ -0,0 +1,79 @@
+import datetime as dt
+import os
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+# Local parquet copy of the daily campaign rows already pulled from BigQuery,
+# one file per source:
+#   <MARKETING_STORE_DIR>/<source>.parquet
+#
+# campaigns.get_campaign_data only queries rows from the watermark - the
+# newest stored segment_date minus a restatement window, since ad platforms
+# keep adjusting cost for a few days - and upserts them into the stored rows
+# by (campaign_id, segment_date).  A missing or unreadable store is a full pull.
+
+MARKETING_STORE_DIR = os.environ.get("MARKETING_STORE_DIR", "/tmp/cl-dashboard-marketing")
+
+# "0" pulls the full history on every refresh, as before
+MARKETING_INCREMENTAL = os.environ.get("MARKETING_INCREMENTAL", "1") != "0"
+
+# Days before the newest stored segment_date that are fetched again on every refresh
+RESTATEMENT_DAYS = int(os.environ.get("MARKETING_RESTATEMENT_DAYS", "7"))
+
+# Campaign names carry language and country from this date on, so nothing earlier is reported
+FIRST_SEGMENT_DATE = dt.date(2024, 5, 1)
+
+ROW_KEY = ["campaign_id", "segment_date"]
+
+
+def store_path(source, store_dir=None):
+    return Path(store_dir or MARKETING_STORE_DIR) / f"{source}.parquet"
+
+
+def read_rows(source, store_dir=None):
+    """The stored rows of a source, or None if there is no usable store."""
+    path = store_path(source, store_dir)
+    if not path.exists():
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return None
+
+
+def write_rows(df, source, store_dir=None):
+    path = store_path(source, store_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written to a temp name first so a crash never leaves a truncated store behind
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def watermark(stored):
+    """First segment_date to fetch: RESTATEMENT_DAYS before the newest stored one."""
+    if stored is None or stored.empty:
+        return FIRST_SEGMENT_DATE
+    newest = pd.to_datetime(stored["segment_date"]).max()
+    if pd.isna(newest):
+        return FIRST_SEGMENT_DATE
+    return max(FIRST_SEGMENT_DATE, newest.date() - dt.timedelta(days=RESTATEMENT_DAYS))
+
+
+def upsert(stored, fetched):
+    """
+    Stored rows with every (campaign_id, segment_date) that was fetched again
+    replaced by the fetched rows for that key.
+    """
+    if stored is None or stored.empty:
+        return fetched.reset_index(drop=True)
+    if fetched.empty:
+        return stored.reset_index(drop=True)
+    refetched = pd.MultiIndex.from_frame(stored[ROW_KEY]).isin(pd.MultiIndex.from_frame(fetched[ROW_KEY]))
+    return pd.concat([stored[~refetched], fetched], ignore_index=True)
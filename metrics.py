@@ -1,54 +1,327 @@
-import streamlit as st
 from rich import print
+import dataclasses
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import datetime as dt
+import cohorts
+import datasets
+import indexes
+import settings
+import users
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 default_daterange = [dt.datetime(2021, 1, 1).date(), dt.date.today()]
 
 def get_filtered_cohort(app, daterange, language, countries_list):
     """Returns (user_cohort_df, user_cohort_df_LR) for app selection."""
-    is_cr = (app == ["CR"] or app == "CR")
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, language, countries_list)
+    version = get_cohort_version()
+    user_cohort_df, user_cohort_df_LR = build_filtered_cohort(version, cohort_filter)
+
+    # Metrics memoized with cohorts.memoize key on these handles instead of hashing the frames
+    cohorts.register(user_cohort_df, cohorts.CohortHandle(version, cohort_filter, "users"))
+    if user_cohort_df_LR is not None:
+        cohorts.register(user_cohort_df_LR, cohorts.CohortHandle(version, cohort_filter, "LR"))
+    return user_cohort_df, user_cohort_df_LR
+
+
+def get_cohort_version():
+    """What cohorts are cut from right now - part of every cohort cache key."""
+    if settings.USER_DATA_MODE == "pushdown":
+        version = users.get_user_data_version()
+    else:
+        # The snapshot being served - it lags the latest export while its replacement builds
+        version = users.get_shared_user_data()["version"]
+    return f"{settings.USER_DATA_MODE}:{version}"
+
+
+@cohorts.memoize
+def build_filtered_cohort(version, cohort_filter):
+    """get_filtered_cohort for a cohorts.CohortFilter, memoized on (version, filter)."""
+    app = cohort_filter.app
+    is_cr = app == ["CR"]
     user_cohort_df_LR = None
-    session_df = select_user_dataframe(app=app)
+
+    source = get_cohort_source(cohort_filter)
+    first_open_index = source.get("first_open_index", {})
+    dimension_index = source.get("dimension_index", {})
+
+    key = select_user_dataset_key(app=app)
     user_cohort_df = get_user_cohort_df(
-        session_df=session_df,
-        daterange=daterange,
-        languages=language,
-        countries_list=countries_list,
-        app=app
+        session_df=source[key],
+        daterange=cohort_filter.daterange,
+        languages=cohort_filter.language,
+        countries_list=cohort_filter.countries_list,
+        app=app,
+        first_open_index=first_open_index.get(key),
+        dimension_index=dimension_index.get(key),
     )
     if is_cr:
-        session_df_LR = select_user_dataframe(app=app, stat="LR")
+        key_LR = select_user_dataset_key(app=app, stat="LR")
         user_cohort_df_LR = get_user_cohort_df(
-            session_df=session_df_LR,
-            daterange=daterange,
-            languages=language,
-            countries_list=countries_list,
-            app=app
+            session_df=source[key_LR],
+            daterange=cohort_filter.daterange,
+            languages=cohort_filter.language,
+            countries_list=cohort_filter.countries_list,
+            app=app,
+            first_open_index=first_open_index.get(key_LR),
+            dimension_index=dimension_index.get(key_LR),
         )
     return user_cohort_df, user_cohort_df_LR
 
 
-def select_user_dataframe(app, stat=None):
+def get_filtered_cohort_size(app, daterange, language, countries_list):
+    """
+    Number of users get_filtered_cohort would return in user_cohort_df.
+    Answered from the indexes alone when they cover the filters, so it is
+    cheap enough to show before the cohort is built.
+    """
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, language, countries_list)
+    source = get_cohort_source(cohort_filter)
+    key = select_user_dataset_key(app=cohort_filter.app)
+    session_df = source[key]
+
+    filters = cohort_dimension_filters(
+        session_df.columns, cohort_filter.language, cohort_filter.countries_list, cohort_filter.app
+    )
+    row_ids = cohort_row_ids(
+        session_df,
+        cohort_filter.daterange,
+        filters,
+        first_open_index=source.get("first_open_index", {}).get(key),
+        dimension_index=source.get("dimension_index", {}).get(key),
+    )
+    if row_ids is not None:
+        return len(row_ids)
+    return len(get_user_cohort_df(
+        session_df, cohort_filter.daterange, cohort_filter.language, cohort_filter.countries_list, cohort_filter.app
+    ))
+
+
+def get_cohort_source(cohort_filter):
+    """The user frames (and their indexes, if any) cohorts are cut from."""
+    # In pushdown mode the frames hold only candidate users for these filters
+    if settings.USER_DATA_MODE == "pushdown":
+        return users.load_user_frames_pushdown(
+            cohort_filter.daterange, cohort_filter.language, cohort_filter.countries_list,
+            users.get_user_data_version(),
+        )
+    return users.get_shared_user_data()
+
+
+def get_cohort_cells(cohort_filter):
+    """
+    The funnel cube cells (users.build_funnel_cube) of the cohort
+    get_filtered_cohort would build for a cohorts.CohortFilter, as
+    (cells, cells_LR) - or None when the user data has no cube (pushdown
+    mode).  Cohort totals are sums over these.
+    """
+    if settings.USER_DATA_MODE == "pushdown":
+        return None
+    cubes = users.get_shared_user_data().get("funnel_cube")
+    if cubes is None:
+        return None
+
+    # The cube has the same filter columns as the user frames, so the same filter applies
+    app = cohort_filter.app
+    filters = (cohort_filter.daterange, cohort_filter.language, cohort_filter.countries_list, app)
+    cells = get_user_cohort_df(cubes[select_user_dataset_key(app=app)], *filters)
+    cells_LR = None
+    if app == ["CR"]:
+        cells_LR = get_user_cohort_df(cubes[select_user_dataset_key(app=app, stat="LR")], *filters)
+    return cells, cells_LR
+
+
+def get_filtered_cohort_totals(app, daterange, language, countries_list, stats=("LR", "LA", "RA", "GC")):
+    """
+    {stat: count} for the cohort get_filtered_cohort would build, LR taken
+    from the app_launch cohort for CR.  Read from the funnel cube when there
+    is one, so no user rows are touched.
+    """
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, language, countries_list)
+    cohort_cells = get_cohort_cells(cohort_filter)
+    if cohort_cells is None:
+        user_cohort_df, user_cohort_df_LR = get_filtered_cohort(app, daterange, language, countries_list)
+        totals = get_cohort_totals(user_cohort_df, tuple(stats))
+        if "LR" in stats:
+            totals["LR"] = len(user_cohort_df_LR if user_cohort_df_LR is not None else user_cohort_df)
+        return totals
+
+    cells, cells_LR = cohort_cells
+    totals = {}
+    for stat in stats:
+        if stat == "LR":
+            totals[stat] = int((cells_LR if cells_LR is not None else cells)["rows"].sum())
+        else:
+            totals[stat] = int(cells[stat].sum()) if stat in cells.columns else 0
+    return totals
+
+
+def get_filtered_cohort_totals_by_group(app, daterange, groupby_cols, stats=("LR", "PC", "LA", "RA")):
+    """
+    get_filtered_cohort_totals for every combination of groupby_cols values
+    (e.g. country x app_language) in one grouped pass instead of one cohort
+    per combination.  Returns the groupby_cols (as plain values) plus one
+    column per stat; combinations without any users are absent.
+    """
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, None, None)
+    cohort_cells = get_cohort_cells(cohort_filter)
+    if cohort_cells is None:
+        # No cube (pushdown mode): sum the cohort rows into cells of their own
+        user_cohort_df, user_cohort_df_LR = get_filtered_cohort(app, daterange, ["All"], ["All"])
+        cohort_cells = (
+            users.build_funnel_cube(user_cohort_df, users.CUBE_USER_KEYS[select_user_dataset_key(app)]),
+            None if user_cohort_df_LR is None else users.build_funnel_cube(
+                user_cohort_df_LR, users.CUBE_USER_KEYS[select_user_dataset_key(app, stat="LR")]
+            ),
+        )
+    cells, cells_LR = cohort_cells
+
+    def group_sums(df, columns):
+        sums = df.groupby(groupby_cols, observed=True, as_index=False)[columns].sum()
+        return sums.astype({col: object for col in groupby_cols})
+
+    step_stats = [s for s in stats if s != "LR" and s in cells.columns]
+    totals = group_sums(cells, step_stats)
+    if "LR" in stats:
+        # Counted like get_filtered_cohort_totals: rows of the app_launch cohort for CR
+        LR = group_sums(cells_LR if cells_LR is not None else cells, ["rows"]).rename(columns={"rows": "LR"})
+        totals = LR.merge(totals, on=groupby_cols, how="outer")
+
+    totals = totals.fillna({s: 0 for s in stats if s in totals.columns})
+    for stat in stats:
+        totals[stat] = totals[stat].astype("int64") if stat in totals.columns else 0
+    return totals[list(groupby_cols) + list(stats)]
+
+
+def get_cohort_funnel(app, daterange, language, countries_list, groupby_col="app_language", min_funnel=False):
+    """
+    funnel_percent_by_group for the cohort get_filtered_cohort would build,
+    from the funnel cube when there is one.
+    """
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, language, countries_list)
+    cohort_cells = get_cohort_cells(cohort_filter)
+    if cohort_cells is None:
+        user_cohort_df, user_cohort_df_LR = get_filtered_cohort(app, daterange, language, countries_list)
+        return funnel_percent_by_group(
+            user_cohort_df, user_cohort_df_LR, groupby_col=groupby_col, app=cohort_filter.app, min_funnel=min_funnel
+        )
+    cells, cells_LR = cohort_cells
+    return cube_funnel_by_group(cells, cells_LR, groupby_col=groupby_col, app=cohort_filter.app, min_funnel=min_funnel)
+
+
+def get_multi_app_cohort(apps, daterange, language, countries_list):
+    """
+    The same filters evaluated for each of `apps`, once: {app: (cells,
+    cells_LR)} funnel cube cells per app, as get_cohort_cells returns them.
+    The tiles (multi_app_totals) and the per-country / per-language tables
+    (multi_app_funnel_by_group) are all read from this one result.
+    """
+    cohort_filter = cohorts.CohortFilter.from_selection(apps, daterange, language, countries_list)
+    return build_multi_app_cohort(get_cohort_version(), cohort_filter)
+
+
+def map_apps(func, apps):
+    """
+    {app: func(app)} with the apps evaluated concurrently on up to
+    settings.MULTI_APP_WORKERS threads.  Workers run in the caller's
+    Streamlit script context so caches and the cohort memo behave as they
+    would on the script thread.
+    """
+    apps = list(apps)
+    if len(apps) <= 1 or settings.MULTI_APP_WORKERS <= 1:
+        return {app: func(app) for app in apps}
+
+    ctx = get_script_run_ctx()
+
+    def run(app):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(app)
+
+    with ThreadPoolExecutor(max_workers=min(settings.MULTI_APP_WORKERS, len(apps))) as pool:
+        return dict(zip(apps, pool.map(run, apps)))
+
+
+@cohorts.memoize
+def build_multi_app_cohort(version, cohort_filter):
+    def app_cells(app):
+        app_filter = dataclasses.replace(cohort_filter, apps=(app,))
+        cells = get_cohort_cells(app_filter)
+        if cells is None:
+            # No cube (pushdown mode): sum this app's cohort rows into cells of its own
+            user_cohort_df, user_cohort_df_LR = build_filtered_cohort(version, app_filter)
+            cells = (
+                users.build_funnel_cube(user_cohort_df, users.CUBE_USER_KEYS[select_user_dataset_key([app])]),
+                None if user_cohort_df_LR is None else users.build_funnel_cube(
+                    user_cohort_df_LR, users.CUBE_USER_KEYS[select_user_dataset_key([app], stat="LR")]
+                ),
+            )
+        return cells
+
+    return map_apps(app_cells, cohort_filter.apps)
+
+
+def multi_app_totals(multi_app_cohort):
+    """
+    LR/PC/LA/RA/GC summed over the apps of get_multi_app_cohort, with GPP and
+    GCA averaged across apps weighted by each app's LR.  The per-app step
+    counts are computed concurrently (map_apps).
+    """
+    stats = ["LR", "PC", "LA", "RA", "GC"]
+    per_app = map_apps(
+        lambda app: cube_step_counts(*multi_app_cohort[app], stats), multi_app_cohort
+    )
+
+    totals = {s: 0 for s in stats}
+    weighted_gpp_sum = 0.0
+    weighted_gca_sum = 0.0
+    total_LR_for_weights = 0
+
+    for counts in per_app.values():
+        LR_i = counts["LR"]
+        for k in totals:
+            totals[k] += counts[k]
+        if LR_i > 0:
+            weighted_gpp_sum += counts["GPP"] * LR_i
+            weighted_gca_sum += counts["GCA"] * LR_i
+            total_LR_for_weights += LR_i
+
+    totals["GPP"] = weighted_gpp_sum / total_LR_for_weights if total_LR_for_weights > 0 else 0.0
+    totals["GCA"] = weighted_gca_sum / total_LR_for_weights if total_LR_for_weights > 0 else 0.0
+    return totals
+
+
+def multi_app_funnel_by_group(multi_app_cohort, groupby_col="country"):
+    """
+    Compact funnel (LR, PC, LA, RA, GC, GPP, GCA) per group across the apps
+    of get_multi_app_cohort, in the funnel_percent_by_group layout.  Each
+    app's LR counts the way its own funnel does (app_launch users for CR).
+    """
+    cells_list = [cells for cells, _ in multi_app_cohort.values()]
+    lr_cells_list = [
+        cells if cells_LR is None else cells_LR for cells, cells_LR in multi_app_cohort.values()
+    ]
+    return funnel_from_cells(cells_list, lr_cells_list, groupby_col, ["LR", "PC", "LA", "RA", "GC"])
+
+
+def select_user_dataset_key(app, stat=None):
+    """Which user frame an app selection reads ("df_cr_users", "df_unity_users" or "df_cr_app_launch")."""
     apps = [app] if isinstance(app, str) else app
 
     if "Unity" in apps:
-        df = st.session_state.df_unity_users
-        return df
-
-    elif any(a.endswith("-standalone") for a in apps if isinstance(a, str)):
-        df = st.session_state.df_cr_users
-        if "All" not in apps:
-            df = df[df["app"].isin(apps)]
-        return df
+        return "df_unity_users"
 
+    # Standalone apps share df_cr_users; get_user_cohort_df narrows it by app
     elif apps == ["CR"] and stat == "LR":
-        df = st.session_state.df_cr_app_launch
-        return df
+        return "df_cr_app_launch"
 
     else:
-        df = st.session_state.df_cr_users
-        return df
+        return "df_cr_users"
+
+
+datasets.register_columns(["first_open", "country", "app_language", "app"])
 
 def get_user_cohort_df(
     session_df,
@@ -56,38 +329,111 @@ def get_user_cohort_df(
     languages=["All"],
     countries_list=["All"],
     app=None,
+    first_open_index=None,
+    dimension_index=None,
 ):
     """
     Returns a DataFrame (all columns) for the cohort matching filters.
-    - df: DataFrame to filter (already chosen by select_user_dataframe)
-    - user_list_key: which column uniquely identifies users
+    - session_df: user frame to filter (the one select_user_dataset_key picks)
+    - first_open_index: indexes.FirstOpenIndex for session_df, if it is sorted by first_open
+    - dimension_index: {column: indexes.DimensionIndex} for session_df, if it has them
+
+    The result never shares its object with session_df, but it isn't a deep copy
+    either - copy-on-write keeps changes to it from reaching the shared frame.
     """
-    cohort_df = session_df.copy()
+    filters = cohort_dimension_filters(session_df.columns, languages, countries_list, app)
+    if filters:
+        # Resolve the whole filter on row ids first, then gather just those rows
+        row_ids = cohort_row_ids(session_df, daterange, filters, first_open_index, dimension_index)
+        if row_ids is not None:
+            return session_df.take(row_ids)
 
     # Apply filters
     if daterange is not None and len(daterange) == 2:
         start = pd.to_datetime(daterange[0])
         end = pd.to_datetime(daterange[1])
-        cohort_df = cohort_df[
-        (cohort_df["first_open"] >= start) & (cohort_df["first_open"] <= end)
-        ]
+        if first_open_index is not None:
+            # Binary search on the sorted first_open - the rest only scans this slice
+            lo, hi = first_open_index.bounds(start, end)
+            cohort_df = session_df.iloc[lo:hi]
+        else:
+            cohort_df = session_df[
+            (session_df["first_open"] >= start) & (session_df["first_open"] <= end)
+            ]
+    else:
+        cohort_df = session_df.iloc[:]
+
+    for col, values in filters.items():
+        cohort_df = cohort_df[cohort_df[col].isin(values)]
+
+    return cohort_df
+
 
+def cohort_dimension_filters(columns, languages=["All"], countries_list=["All"], app=None):
+    """{column: allowed values} for the dimension filters that are set."""
+    filters = {}
     if countries_list and countries_list != ["All"]:
-        cohort_df = cohort_df[cohort_df["country"].isin(countries_list)]
-        
+        filters["country"] = countries_list
+
     if languages and languages != ["All"]:
-        lang_col = "app_language" if "app_language" in cohort_df.columns else "language"
-        cohort_df = cohort_df[cohort_df[lang_col].isin(languages)]
-        
-    if app and app != ["All"] and "app" in cohort_df.columns:
-        apps = [app] if isinstance(app, str) else app
-        cohort_df = cohort_df[cohort_df["app"].isin(apps)]
-        
+        lang_col = "app_language" if "app_language" in columns else "language"
+        filters[lang_col] = languages
 
-    return cohort_df
+    if app and app != ["All"] and "app" in columns:
+        filters["app"] = [app] if isinstance(app, str) else app
+
+    return filters
+
+
+def cohort_row_ids(session_df, daterange, filters, first_open_index=None, dimension_index=None):
+    """
+    Sorted row positions of the cohort, worked out from the indexes without
+    reading any column, or None when the indexes can't answer the filters.
+    """
+    if dimension_index is None or not all(col in dimension_index for col in filters):
+        return None
+
+    lo, hi = 0, len(session_df)
+    if daterange is not None and len(daterange) == 2:
+        if first_open_index is None:
+            return None
+        lo, hi = first_open_index.bounds(pd.to_datetime(daterange[0]), pd.to_datetime(daterange[1]))
+
+    if not filters:
+        return np.arange(lo, hi)
+    return indexes.intersect_rows(
+        [dimension_index[col].rows(values, lo, hi) for col, values in filters.items()]
+    )
+
+
+FUNNEL_STATS = ["LR", "DC", "TS", "SL", "PC", "LA", "RA", "GC"]
+
+# Funnel steps read off furthest_event, as the lowest datasets.EVENT_ORDER rank they include
+EVENT_STEP_RANK = {"DC": 0, "TS": 1, "SL": 2, "PC": 3}
+
+# Funnel steps read off the funnel_flags bits
+FLAG_STEPS = {"LA": datasets.FUNNEL_FLAG_LA, "RA": datasets.FUNNEL_FLAG_RA, "GC": datasets.FUNNEL_FLAG_GC}
+
+# The funnel counts below read user ids and the columns the funnel codes are derived from
+datasets.register_columns(
+    ["cr_user_id", "user_pseudo_id", "furthest_event", "max_user_level", "gpc"]
+)
+
+
+def cohort_funnel_rank(cohort_df):
+    """funnel_rank of each row - precomputed at load, derived here for other frames."""
+    if "funnel_rank" in cohort_df.columns:
+        return cohort_df["funnel_rank"].to_numpy()
+    return users.funnel_rank(cohort_df["furthest_event"])
+
+
+def cohort_funnel_flags(cohort_df):
+    """funnel_flags of each row - precomputed at load, derived here for other frames."""
+    if "funnel_flags" in cohort_df.columns:
+        return cohort_df["funnel_flags"].to_numpy()
+    return users.funnel_flags(cohort_df["max_user_level"], cohort_df["gpc"])
 
 
-@st.cache_data(ttl="1d", show_spinner=False)
 def get_cohort_totals_by_metric(
     cohort_df,
     stat="LR"
@@ -97,61 +443,71 @@ def get_cohort_totals_by_metric(
     - cohort_df: DataFrame, filtered to your user cohort (one row per user)
     - stat: string, which funnel metric to count ("LR", "DC", "TS", "SL", "PC", "LA", "RA", "GC")
     """
+    return get_cohort_totals(cohort_df, (stat,))[stat]
+
+
+@cohorts.memoize
+def get_cohort_totals(cohort_df, stats=tuple(FUNNEL_STATS)):
+    """
+    {stat: count} for several funnel stats of one cohort at once.
+    - LR: every user in the cohort
+    - DC / TS / SL / PC: furthest_event reached that step or a later one
+    - LA / RA / GC: max_user_level >= 1 / >= 25 / >= 1 with gpc >= 90
+    Unknown stats count 0.
+    """
+    totals = {}
+    reached = None
+    flags = None
+    for stat in stats:
+        if stat == "LR":
+            totals[stat] = len(cohort_df)
+        elif stat in EVENT_STEP_RANK:
+            if reached is None:
+                # ✅ One bincount over the ranks, then a reverse cumsum: reached[r] = users at rank >= r
+                ranks = cohort_funnel_rank(cohort_df)
+                per_rank = np.bincount(ranks[ranks >= 0], minlength=len(datasets.EVENT_ORDER))
+                reached = per_rank[::-1].cumsum()[::-1]
+            totals[stat] = int(reached[EVENT_STEP_RANK[stat]])
+        elif stat in FLAG_STEPS:
+            if flags is None:
+                flags = cohort_funnel_flags(cohort_df)
+            totals[stat] = int(np.count_nonzero(flags & FLAG_STEPS[stat]))
+        else:
+            totals[stat] = 0  # default fallback
+    return totals
+
+
+def group_codes(values, groups):
+    """Position of each value in the sorted `groups` list, -1 for missing values."""
+    return pd.Categorical(values, categories=groups).codes.astype(np.intp)
+
+
+def count_unique_by_group(values, codes, n_groups):
+    """Distinct non-null values per group code, as an array of length n_groups."""
+    counts = values[codes >= 0].groupby(codes[codes >= 0]).nunique()
+    return counts.reindex(range(n_groups), fill_value=0).to_numpy()
 
-    # Stat-specific filters (formerly in filter_user_data)
-    if stat == "LA":
-        # Learners Acquired: max_user_level >= 1
-        return (cohort_df['max_user_level'] >= 1).sum()
-    elif stat == "RA":
-        # Readers Acquired: max_user_level >= 25
-        return (cohort_df['max_user_level'] >= 25).sum()
-    elif stat == "GC":
-        # Game Completed: max_user_level >= 1 AND gpc >= 90
-        return ((cohort_df['max_user_level'] >= 1) & (cohort_df['gpc'] >= 90)).sum()
-    elif stat == "LR":
-        # Learner Reached: all users in cohort
-        return len(cohort_df)
-
-    # Otherwise: classic funnel by furthest_event
-    furthest = cohort_df["furthest_event"]
-
-    download_completed_count = (furthest == "download_completed").sum()
-    tapped_start_count      = (furthest == "tapped_start").sum()
-    selected_level_count    = (furthest == "selected_level").sum()
-    puzzle_completed_count  = (furthest == "puzzle_completed").sum()
-    level_completed_count   = (furthest == "level_completed").sum()
-
-    if stat == "DC":
-        return (
-            download_completed_count
-            + tapped_start_count
-            + selected_level_count
-            + puzzle_completed_count
-            + level_completed_count
-        )
-    if stat == "TS":
-        return (
-            tapped_start_count
-            + selected_level_count
-            + puzzle_completed_count
-            + level_completed_count
-        )
-    if stat == "SL":
-        return (
-            selected_level_count
-            + puzzle_completed_count
-            + level_completed_count
-        )
-    if stat == "PC":
-        return (
-            puzzle_completed_count
-            + level_completed_count
-        )
 
-    return 0  # default fallback
+def add_percent_columns(df, funnel_steps):
+    """
+    Add the '_pct' columns (share of LR) to a per-group funnel frame and drop
+    the groups with no users past LR.  Returns (df, mask of the rows kept).
+    """
+    # --- Percent-normalized columns ---
+    norm_steps = [s for s in funnel_steps if s != "LR"]
+    for step in funnel_steps:
+        if step == "LR":
+            df[f"{step}_pct"] = 100.0
+        else:
+            df[f"{step}_pct"] = df[step] / df["LR"] * 100
+
+    # --- Drop rows where all post-LR steps are zero (optional) ---
+    all_zero = (df[norm_steps].fillna(0).astype(float) == 0).all(axis=1)
+    keep = ~all_zero.to_numpy()
+    return df[keep].reset_index(drop=True), keep
 
 
-@st.cache_data(ttl="1d", show_spinner=False)
+@cohorts.memoize
 def funnel_percent_by_group(
     cohort_df,
     cohort_df_LR=None,
@@ -186,7 +542,7 @@ def funnel_percent_by_group(
     # ✅ Short-circuit: handle datasets without furthest_event (e.g., CR app_launch / LR)
     if "furthest_event" not in cohort_df.columns:
         df = (
-            cohort_df.groupby(groupby_col, dropna=False)
+            cohort_df.groupby(groupby_col, dropna=False, observed=True)
             .agg({user_key: "nunique"})
             .reset_index()
             .rename(columns={user_key: "LR"})
@@ -198,80 +554,151 @@ def funnel_percent_by_group(
     group_vals = set(cohort_df[groupby_col].dropna().unique())
     if cohort_df_LR is not None:
         group_vals |= set(cohort_df_LR[groupby_col].dropna().unique())
-
-    records = []
-    for group in sorted(group_vals):
-        # LR count (special handling for CR with separate LR df)
-        if app_name == "CR" and cohort_df_LR is not None:
-            group_LR = cohort_df_LR[cohort_df_LR[groupby_col] == group]
-            count_LR = (
-                group_LR[user_key].nunique() if user_key in group_LR else len(group_LR)
-            )
+    groups = sorted(group_vals)
+    n_groups = len(groups)
+
+    # ✅ Every row gets the position of its group in `groups` (-1 when missing),
+    # so all steps below are one bincount / groupby over these codes
+    codes = group_codes(cohort_df[groupby_col], groups)
+    in_group = codes >= 0
+
+    # LR count (special handling for CR with separate LR df)
+    lr_df = cohort_df_LR if app_name == "CR" and cohort_df_LR is not None else cohort_df
+    lr_codes = group_codes(lr_df[groupby_col], groups)
+    if user_key in lr_df:
+        count_LR = count_unique_by_group(lr_df[user_key], lr_codes, n_groups)
+    else:
+        count_LR = np.bincount(lr_codes[lr_codes >= 0], minlength=n_groups)
+
+    df = pd.DataFrame({groupby_col: pd.Series(groups, dtype=object), "LR": count_LR})
+
+    # DC / TS / SL / PC: users whose furthest_event reached that event or any later one
+    event_rank = cohort_funnel_rank(cohort_df).astype(np.intp)
+    ranked = in_group & (event_rank >= 0)
+    per_event = np.bincount(
+        codes[ranked] * len(datasets.EVENT_ORDER) + event_rank[ranked],
+        minlength=n_groups * len(datasets.EVENT_ORDER),
+    ).reshape(n_groups, len(datasets.EVENT_ORDER))
+    reached = per_event[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+    flags = cohort_funnel_flags(cohort_df)
+    for step in funnel_steps[1:]:
+        if step in EVENT_STEP_RANK:
+            df[step] = reached[:, EVENT_STEP_RANK[step]]
         else:
-            group_LR = cohort_df[cohort_df[groupby_col] == group]
-            count_LR = (
-                group_LR[user_key].nunique() if user_key in group_LR else len(group_LR)
-            )
+            df[step] = np.bincount(codes[in_group & ((flags & FLAG_STEPS[step]) > 0)], minlength=n_groups)
 
-        row = {groupby_col: group, "LR": count_LR}
-        group_df = cohort_df[cohort_df[groupby_col] == group]
+    df, keep = add_percent_columns(df, funnel_steps)
 
-        for step in funnel_steps[1:]:
-            row[step] = get_cohort_totals_by_metric(group_df, stat=step)
+    # --- Add GPP and GCA if gpc exists ---
+    if "gpc" in cohort_df.columns:
+        la = in_group & ((flags & datasets.FUNNEL_FLAG_LA) > 0)
+        la_codes = codes[la]
+        la_gpc = cohort_df["gpc"][la]
 
-        records.append(row)
+        # GPP = average gpc among LA users
+        gpp = la_gpc.groupby(la_codes).mean().fillna(0)
+        df["GPP"] = gpp.reindex(np.flatnonzero(keep)).to_numpy()
+        df["GPP_pct"] = df["GPP"]  # maintain consistent suffix pattern
 
-    df = pd.DataFrame(records)
+        # GCA = % of LA users with gpc >= 90
+        la_users = cohort_df[user_key][la]
+        la_total = la_users.groupby(la_codes).nunique()
+        completed = (la_gpc >= 90).to_numpy()
+        gc_count = la_users[completed].groupby(la_codes[completed]).nunique()
+        gc_count = gc_count.reindex(la_total.index, fill_value=0)
+        gca = (gc_count / la_total * 100).round(2)
+        df["GCA"] = gca.reindex(np.flatnonzero(keep)).to_numpy()
+        df["GCA_pct"] = df["GCA"]
 
-    # --- Percent-normalized columns ---
-    norm_steps = [s for s in funnel_steps if s != "LR"]
-    for step in funnel_steps:
-        if step == "LR":
-            df[f"{step}_pct"] = 100.0
-        else:
-            df[f"{step}_pct"] = df[step] / df["LR"] * 100
+        # Extend funnel_steps for downstream charts/tables
+        funnel_steps = funnel_steps + ["GPP", "GCA"]
 
-    # --- Drop rows where all post-LR steps are zero (optional) ---
-    all_zero = (df[norm_steps].fillna(0).astype(float) == 0).all(axis=1)
-    df = df[~all_zero].reset_index(drop=True)
+    return df, funnel_steps
+
+def cube_funnel_by_group(
+    cells,
+    cells_LR=None,
+    groupby_col="app_language",
+    app=None,
+    min_funnel=False
+):
+    """
+    funnel_percent_by_group computed from funnel cube cells instead of user
+    rows: the same frame and funnel_steps, from per-group sums of the cells.
+    """
+    app_name = app[0] if isinstance(app, list) and len(app) > 0 else app
+    app_name = str(app_name) if app_name is not None else ""
+
+    funnel_steps = ["LR", "PC", "LA", "RA", "GC"]
+    if app_name == "CR" and not min_funnel:
+        funnel_steps = ["LR", "DC", "TS", "SL", "PC", "LA", "RA", "GC"]
+
+    # LR count (special handling for CR with separate LR df)
+    lr_cells = cells_LR if app_name == "CR" and cells_LR is not None else cells
+    group_cells = [cells] if cells_LR is None else [cells, cells_LR]
+    return funnel_from_cells([cells], [lr_cells], groupby_col, funnel_steps, group_cells)
+
+
+def funnel_from_cells(cells_list, lr_cells_list, groupby_col, funnel_steps, group_cells_list=None):
+    """
+    The funnel_percent_by_group frame from funnel cube cells.  The cells of
+    several cohorts (e.g. one per app) are summed per group one frame at a
+    time, never concatenated; LR comes from lr_cells_list, and the groups
+    are every value in group_cells_list (all the cells by default).
+    """
+    if group_cells_list is None:
+        group_cells_list = list(cells_list) + list(lr_cells_list)
+
+    def group_sums(frames, columns):
+        parts = []
+        for df in frames:
+            sums = df.groupby(groupby_col, observed=True)[columns].sum()
+            parts.append(sums.set_axis(sums.index.astype(object)))
+        return parts[0] if len(parts) == 1 else pd.concat(parts).groupby(level=0).sum()
+
+    count_cols = [
+        c for c in cells_list[0].columns
+        if c not in users.CUBE_DIMENSIONS and all(c in df.columns for df in cells_list)
+    ]
+    sums = group_sums(cells_list, count_cols)
+    group_vals = set()
+    for df in group_cells_list:
+        group_vals |= set(df[groupby_col].dropna().unique())
+    groups = sorted(group_vals)
+    sums = sums.reindex(groups, fill_value=0)
+
+    count_LR = group_sums(lr_cells_list, ["users"])["users"].reindex(groups, fill_value=0)
+
+    df = pd.DataFrame({groupby_col: pd.Series(groups, dtype=object), "LR": count_LR.to_numpy()})
+    for step in funnel_steps[1:]:
+        df[step] = sums[step].to_numpy()
+
+    df, keep = add_percent_columns(df, funnel_steps)
 
     # --- Add GPP and GCA if gpc exists ---
-    if "gpc" in cohort_df.columns:
-        la_df = cohort_df[cohort_df["max_user_level"] >= 1].copy()
+    if "gpc_sum" in sums.columns:
+        sums = sums[keep]
+        has_la = (sums["LA"] > 0).to_numpy()
 
         # GPP = average gpc among LA users
-        gpp = (
-            la_df.groupby(groupby_col)["gpc"]
-            .mean()
-            .reset_index(name="GPP")
-            .fillna(0)
-        )
-        df = df.merge(gpp, on=groupby_col, how="left")
-        df["GPP_pct"] = df["GPP"]  # maintain consistent suffix pattern
+        gpp = (sums["gpc_sum"] / sums["gpc_count"]).fillna(0)
+        df["GPP"] = gpp.to_numpy()
+        df.loc[~has_la, "GPP"] = np.nan
+        df["GPP_pct"] = df["GPP"]
 
         # GCA = % of LA users with gpc >= 90
-        total_counts = (
-            la_df.groupby(groupby_col)[user_key]
-            .nunique()
-            .reset_index(name="LA_total")
-        )
-        gc_counts = (
-            la_df[la_df["gpc"] >= 90]
-            .groupby(groupby_col)[user_key]
-            .nunique()
-            .reset_index(name="GC_count")
-        )
-        gca = total_counts.merge(gc_counts, on=groupby_col, how="left").fillna(0)
-        gca["GCA"] = (gca["GC_count"] / gca["LA_total"] * 100).round(2)
-        df = df.merge(gca[[groupby_col, "GCA"]], on=groupby_col, how="left")
+        gca = (sums["GC_users"] / sums["LA_users"] * 100).round(2)
+        df["GCA"] = gca.to_numpy()
+        df.loc[~has_la, "GCA"] = np.nan
         df["GCA_pct"] = df["GCA"]
 
-        # Extend funnel_steps for downstream charts/tables
         funnel_steps = funnel_steps + ["GPP", "GCA"]
 
     return df, funnel_steps
 
-@st.cache_data(ttl="1d", show_spinner=False)
+
+@cohorts.memoize
 def get_sorted_funnel_df(
     cohort_df,
     cohort_df_LR=None,
@@ -281,7 +708,8 @@ def get_sorted_funnel_df(
     stat="LA",
     sort_by="Total",
     ascending=False,
-    use_top_ten=True
+    use_top_ten=True,
+    funnel=None,
 ):
     """
     Returns a funnel dataframe (with counts and percentages) sorted by the chosen stat.
@@ -307,6 +735,9 @@ def get_sorted_funnel_df(
         Sort ascending (lowest first) or descending (highest first)
     use_top_ten : bool, default True
         If True, return top 10 rows
+    funnel : tuple, optional
+        Already computed (funnel_df, funnel_steps) to sort, e.g. from
+        multi_app_funnel_by_group; the cohort frames are not used then
 
     Returns
     -------
@@ -317,13 +748,15 @@ def get_sorted_funnel_df(
     """
 
     # --- Compute the funnel + percentages ---
-    df, funnel_steps = funnel_percent_by_group(
-        cohort_df=cohort_df,
-        cohort_df_LR=cohort_df_LR,
-        groupby_col=groupby_col,
-        app=app,
-        min_funnel=min_funnel
-    )
+    if funnel is None:
+        funnel = funnel_percent_by_group(
+            cohort_df=cohort_df,
+            cohort_df_LR=cohort_df_LR,
+            groupby_col=groupby_col,
+            app=app,
+            min_funnel=min_funnel
+        )
+    df, funnel_steps = funnel
 
     # --- Normalize the metric name (case-insensitive) ---
     stat = stat.upper().strip()
@@ -354,7 +787,7 @@ def get_sorted_funnel_df(
 
     return df, funnel_steps
 
-@st.cache_data(ttl="1d", show_spinner=False)
+
 def get_funnel_step_counts_for_app(
     app,
     daterange,
@@ -381,8 +814,19 @@ def get_funnel_step_counts_for_app(
     This function is the backbone of the COMBINED “All apps” calculations.
     """
 
-    # Normalize app – always work with a list
-    apps = [app] if isinstance(app, str) else app
+    cohort_filter = cohorts.CohortFilter.from_selection(app, daterange, language, countries_list, funnel_size)
+    return funnel_step_counts(get_cohort_version(), cohort_filter)
+
+
+@cohorts.memoize
+def funnel_step_counts(version, cohort_filter):
+    """get_funnel_step_counts_for_app for a cohorts.CohortFilter, memoized on (version, filter)."""
+    # The filter in the shapes the code below works with
+    apps = cohort_filter.app
+    daterange = cohort_filter.daterange
+    language = cohort_filter.language
+    countries_list = cohort_filter.countries_list
+    funnel_size = cohort_filter.funnel_size
 
     # Funnel steps
     if funnel_size == "large":
@@ -390,6 +834,13 @@ def get_funnel_step_counts_for_app(
     else:
         stats = ["LR", "PC", "LA", "RA", "GC"]
 
+    # -----------------------------------------
+    # Answer from the funnel cube when there is one
+    # -----------------------------------------
+    cohort_cells = get_cohort_cells(cohort_filter)
+    if cohort_cells is not None:
+        return stats, cube_step_counts(*cohort_cells, stats)
+
     # -----------------------------------------
     # Load this app's cohort (same as funnel page)
     # -----------------------------------------
@@ -438,12 +889,8 @@ def get_funnel_step_counts_for_app(
     # -----------------------------------------
     # Compute PC / LA / RA / GC using same logic as funnel
     # -----------------------------------------
-    for stat in stats:
-        if stat == "LR":
-            continue  # computed above
-
-        c = get_cohort_totals_by_metric(user_cohort_df, stat=stat)
-        counts[stat] = int(c)
+    totals = get_cohort_totals(user_cohort_df, tuple(s for s in stats if s != "LR"))
+    counts.update(totals)
 
     # -----------------------------------------
     # Compute GPP and GCA like funnel_percent_by_group does
@@ -470,6 +917,30 @@ def get_funnel_step_counts_for_app(
     return stats, counts
 
 
+def cube_step_counts(cells, cells_LR, stats):
+    """get_funnel_step_counts_for_app's counts, summed from funnel cube cells."""
+    sums = cells[[c for c in cells.columns if c not in users.CUBE_DIMENSIONS]].sum()
+
+    # LR is distinct users - from the app_launch cells for CR
+    counts = {}
+    if "LR" in stats:
+        counts["LR"] = int((cells_LR if cells_LR is not None else cells)["users"].sum())
+    for stat in stats:
+        if stat != "LR":
+            counts[stat] = int(sums[stat]) if stat in sums else 0
+
+    GPP = 0.0
+    GCA = 0.0
+    if "gpc_sum" in sums and sums["LA"] > 0:
+        # Mean gpc of LA users (NaN if none of them has a gpc), % of them with gpc >= 90
+        GPP = float(sums["gpc_sum"] / sums["gpc_count"]) if sums["gpc_count"] else float("nan")
+        GCA = float(sums["GC"] / sums["LA"] * 100)
+
+    counts["GPP"] = GPP
+    counts["GCA"] = GCA
+    return counts
+
+
 def compute_global_metrics(df):
     """
     Compute global LR/LA/RA/GC totals and weighted GPP/GCA from funnel_df.
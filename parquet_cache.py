@@ -0,0 +1,183 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pyarrow.parquet as pq
+
+import settings
+
+# Local mirror of the nightly run_date parquet exports.
+#
+# Shards are stored content-addressed under
+#   <PARQUET_CACHE_DIR>/<bucket path>/run_date=YYYY-MM-DD/<sha1>.parquet
+# where the sha1 is built from the remote path, its generation (or mtime for
+# filesystems without generations) and its size.  A shard that is already on
+# disk with the same key is never fetched again, so cold starts and cache
+# expiries only download what actually changed.  Works with any fsspec
+# filesystem, so a local directory can stand in for the bucket.
+
+PARQUET_CACHE_DIR = os.environ.get("PARQUET_CACHE_DIR", "/tmp/cl-dashboard-parquet")
+PARQUET_CACHE_MAX_BYTES = int(
+    float(os.environ.get("PARQUET_CACHE_MAX_GB", "8")) * 1024**3
+)
+
+# Shards fetched and decoded at once; the work is network-bound so this can exceed the core count
+PARQUET_FETCH_WORKERS = int(os.environ.get("PARQUET_FETCH_WORKERS", "8"))
+
+RUN_DATE_DIR_RE = re.compile(r"run_date=\d{4}-\d{2}-\d{2}")
+
+
+def shard_key(path, info):
+    """Stable key for a remote shard: path + generation (or mtime) + size."""
+    version = (
+        info.get("generation")
+        or info.get("md5Hash")
+        or info.get("etag")
+        or info.get("mtime")
+        or info.get("updated")
+        or ""
+    )
+    raw = f"{path}|{version}|{info.get('size', '')}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def listing_fingerprint(infos):
+    """
+    Short digest of the shard keys in a {path: info} listing - it changes
+    whenever a shard is added, removed or rewritten.
+    """
+    raw = "|".join(sorted(shard_key(path, info) for path, info in infos.items()))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def local_shard_path(path, info, cache_dir=None):
+    cache_dir = Path(cache_dir or PARQUET_CACHE_DIR)
+    parent = path.rsplit("/", 1)[0].split("://", 1)[-1].strip("/")
+    return cache_dir / parent / f"{shard_key(path, info)}.parquet"
+
+
+def mirror_shard(fs, path, cache_dir=None, info=None):
+    """
+    Return the local path for a remote shard, downloading it only if the
+    (path, generation, size) key is not already on disk.
+    """
+    info = info if info is not None else fs.info(path)
+    local_path = local_shard_path(path, info, cache_dir)
+    if local_path.exists():
+        return local_path
+
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    # Download to a temp name first so a crashed fetch never leaves a
+    # truncated shard behind that would be mistaken for a complete one.
+    tmp_path = local_path.with_name(f".{local_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        fs.get_file(path, str(tmp_path))
+        os.replace(tmp_path, local_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return local_path
+
+
+def mirror_files(fs, files, infos=None, cache_dir=None, max_bytes=None):
+    """
+    Mirror every shard in `files` and return the local paths in the same order.
+    `infos` is an optional {path: info} dict (e.g. from fs.glob(detail=True))
+    that saves one metadata request per shard.
+    """
+    infos = infos or {}
+    local_paths = [str(mirror_shard(fs, f, cache_dir, infos.get(f))) for f in files]
+
+    # Shards of the run_date we just mirrored are the ones in use - never evict those.
+    keep = {str(Path(p).parent) for p in local_paths}
+    evict_old_run_dates(cache_dir, max_bytes, keep=keep)
+    return local_paths
+
+
+def _fetch_and_read(fs, path, info, columns, cache_dir, logger):
+    start = time.perf_counter()
+    local_path = mirror_shard(fs, path, cache_dir, info)
+    fetched = time.perf_counter()
+
+    # Only project the requested columns this shard actually has
+    if columns is not None:
+        available = set(pq.read_schema(local_path).names)
+        columns = [c for c in columns if c in available]
+    table = pq.read_table(local_path, columns=columns)
+    decoded = time.perf_counter()
+
+    logger.debug(
+        f"{path}: {local_path.stat().st_size:,} bytes on disk, "
+        f"fetch {fetched - start:.2f}s, decode {decoded - fetched:.2f}s, {table.num_rows:,} rows"
+    )
+    return local_path, table
+
+
+def read_shards(fs, shards, cache_dir=None, max_bytes=None, max_workers=None):
+    """
+    Mirror and decode many shards concurrently.
+
+    `shards` is a list of (path, info, columns) tuples; info may be None and
+    columns None for all columns.  Each worker fetches a shard and decodes it
+    straight away, so decoding overlaps with the other shards' downloads.
+    Returns the pyarrow tables in the same order as `shards`.
+    """
+    logger = settings.get_logger()  # resolved here - workers have no Streamlit script context
+    with ThreadPoolExecutor(max_workers=max_workers or PARQUET_FETCH_WORKERS) as pool:
+        results = list(pool.map(
+            lambda shard: _fetch_and_read(fs, *shard, cache_dir, logger), shards
+        ))
+
+    keep = {str(local_path.parent) for local_path, _ in results}
+    evict_old_run_dates(cache_dir, max_bytes, keep=keep)
+    return [table for _, table in results]
+
+
+def _dir_size(path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def evict_old_run_dates(cache_dir=None, max_bytes=None, keep=()):
+    """
+    Remove whole run_date folders, oldest run_date first, until the mirror
+    fits in max_bytes.  Folders listed in `keep` are never removed, and
+    neither is the newest run_date of each dataset: that is the run its
+    readers (e.g. a cached pushdown dataset) use, even when the mirror that
+    triggered eviction was for a different dataset.
+    """
+    cache_dir = Path(cache_dir or PARQUET_CACHE_DIR)
+    max_bytes = PARQUET_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not cache_dir.exists():
+        return []
+
+    run_dirs = [
+        d for d in cache_dir.rglob("run_date=*")
+        if d.is_dir() and RUN_DATE_DIR_RE.fullmatch(d.name)
+    ]
+    newest = {}
+    for d in run_dirs:
+        if d.parent not in newest or d.name > newest[d.parent].name:
+            newest[d.parent] = d
+    keep = set(keep) | {str(d) for d in newest.values()}
+
+    sizes = {d: _dir_size(d) for d in run_dirs}
+    total = sum(sizes.values())
+
+    evicted = []
+    for d in sorted(run_dirs, key=lambda d: (d.name, str(d))):
+        if total <= max_bytes:
+            break
+        if str(d) in keep:
+            continue
+        shutil.rmtree(d, ignore_errors=True)
+        total -= sizes[d]
+        evicted.append(str(d))
+
+    if evicted:
+        settings.get_logger().info(f"Evicted {len(evicted)} run_date folders from parquet mirror")
+    return evicted
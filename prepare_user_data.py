@@ -0,0 +1,107 @@
+"""
+Build the dashboard-ready user datasets for one run_date.
+
+Runs the cleaning the dashboard would otherwise run at request time
+(users.prepare_user_frames) over the nightly parquet exports, and writes one
+compact, pre-typed parquet file per dataset sorted by first_open, followed by
+a manifest.json.  Point the dashboard at the output with PREPARED_USER_DATA_PATH.
+
+    python prepare_user_data.py --source gs:// --output gs://user_data_parquet_cache/dashboard_ready
+    python prepare_user_data.py --source ./bucket_copy --output ./dashboard_ready --run-date 2026-10-17
+
+--source is the root the datasets.USER_DATASETS patterns are resolved
+against, so a local copy of the bucket works the same as GCS.
+"""
+import argparse
+import datetime as dt
+import json
+import posixpath
+
+import datasets
+import users
+import metrics  # noqa: F401 - registers the columns the dashboard reads
+
+ROW_GROUP_SIZE = 250_000
+
+
+def resolve_run_dates(fs, root, run_date=None):
+    """{dataset name: run_date} - the given run_date, or the latest of each export."""
+    run_dates = {}
+    for name, spec in datasets.USER_DATASETS.items():
+        pattern = posixpath.join(root, spec["pattern"])
+        if run_date:
+            pattern = pattern.replace("run_date=*", f"run_date={run_date}")
+        files, _ = users.list_latest_run(fs, pattern)
+        run_dates[name] = users.RUN_DATE_RE.search(files[0]).group(0).strip("/").split("=")[1]
+    return run_dates
+
+
+def prepare(source, output, run_date=None):
+    src_fs, src_root = users.get_filesystem(source)
+    out_fs, out_root = users.get_filesystem(output)
+
+    run_dates = resolve_run_dates(src_fs, src_root, run_date)
+    requests = [
+        (
+            posixpath.join(src_root, spec["pattern"]).replace("run_date=*", f"run_date={run_dates[name]}"),
+            datasets.get_columns(name),
+        )
+        for name, spec in datasets.USER_DATASETS.items()
+    ]
+    raw = dict(zip(datasets.USER_DATASETS, users.read_latest_runs(requests, fs=src_fs)))
+
+    frames = users.prepare_user_frames(
+        raw[datasets.CR_USER_PROGRESS],
+        raw[datasets.UNITY_USER_PROGRESS],
+        raw[datasets.CR_APP_LAUNCH],
+    )
+    frames = dict(zip(
+        [datasets.CR_USER_PROGRESS, datasets.UNITY_USER_PROGRESS, datasets.CR_APP_LAUNCH], frames
+    ))
+
+    out_run_date = max(run_dates.values())
+    run_dir = posixpath.join(out_root, f"run_date={out_run_date}")
+    out_fs.makedirs(run_dir, exist_ok=True)
+
+    manifest = {
+        "run_date": out_run_date,
+        "source_run_dates": run_dates,
+        "created_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        "datasets": {},
+    }
+    for name, df in frames.items():
+        # Sorted by first_open so date ranges are contiguous slices once loaded
+        df = df.sort_values("first_open", kind="stable", na_position="last").reset_index(drop=True)
+
+        file_name = f"{name}.parquet"
+        path = posixpath.join(run_dir, file_name)
+        with out_fs.open(path, "wb") as f:
+            df.to_parquet(f, index=False, row_group_size=ROW_GROUP_SIZE)
+
+        manifest["datasets"][name] = {
+            "file": file_name,
+            "rows": len(df),
+            "bytes": out_fs.size(path),
+            "columns": {col: str(dtype) for col, dtype in df.dtypes.items()},
+        }
+        print(f"{name}: {len(df):,} rows -> {path}")
+
+    # Written last: the dashboard only picks up runs that have a manifest
+    with out_fs.open(posixpath.join(run_dir, users.PREPARED_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="gs://", help="root of the nightly exports (gs:// or a local directory)")
+    parser.add_argument("--output", required=True, help="where to write the prepared run (gs:// url or local directory)")
+    parser.add_argument("--run-date", default=None, help="YYYY-MM-DD export to prepare; defaults to the latest")
+    args = parser.parse_args()
+
+    prepare(args.source, args.output, args.run_date)
+
+
+if __name__ == "__main__":
+    main()
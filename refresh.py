@@ -0,0 +1,128 @@
+import datetime as dt
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Process-wide snapshots of whole datasets (user exports, marketing data) that
+# refresh in the background instead of expiring.
+#
+# With ttl="1d" every session that arrives just after an expiry starts its own
+# full load and waits on a spinner.  A RefreshingCache instead:
+#   - runs at most one load per key at a time (single-flight); callers that
+#     need a value that doesn't exist yet wait on that one load
+#   - keeps serving the previous snapshot while its replacement is built, and
+#     swaps the new one in only once it is complete
+#   - decides a snapshot is stale from a version token check (e.g.
+#     users.get_user_data_version), or by default from the nightly export
+#     schedule, rather than from its age.
+
+# When the nightly exports have landed, as HH:MM UTC
+NIGHTLY_EXPORT_UTC = os.environ.get("NIGHTLY_EXPORT_UTC", "06:00")
+
+# After a failed refresh, keep serving the old snapshot this long before retrying
+REFRESH_RETRY_SECONDS = int(os.environ.get("REFRESH_RETRY_SECONDS", "600"))
+
+
+def last_export_time(now=None):
+    """The most recent nightly export time (UTC) at or before `now`."""
+    now = now or dt.datetime.now(dt.timezone.utc)
+    hour, minute = (int(part) for part in NIGHTLY_EXPORT_UTC.split(":"))
+    export = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return export if export <= now else export - dt.timedelta(days=1)
+
+
+def loaded_before_last_export(entry):
+    """Default staleness: the snapshot predates the latest nightly export."""
+    return entry.loaded_at < last_export_time()
+
+
+class Snapshot:
+    def __init__(self, value, loaded_at):
+        self.value = value
+        self.loaded_at = loaded_at
+
+
+class RefreshingCache:
+    """
+    Single-flight, stale-while-revalidate cache of load(*key).  `is_stale`
+    gets the current Snapshot (value, loaded_at) and says whether a
+    background refresh is due.
+    """
+
+    def __init__(self, name, load, is_stale=loaded_before_last_export, spinner=None):
+        self.name = name
+        self.load = load
+        self.is_stale = is_stale
+        self.spinner = spinner
+        self.snapshots = {}  # key -> Snapshot
+        self.in_flight = {}  # key -> Future of the running load
+        self.failed_at = {}  # key -> time.monotonic() of the last failed refresh
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"refresh-{name}")
+
+    def get(self, *key):
+        with self.lock:
+            snapshot = self.snapshots.get(key)
+            if snapshot is None:
+                future = self._start(key)
+
+        if snapshot is not None:
+            # Checked outside the lock - is_stale may list a bucket
+            if self._refresh_due(key, snapshot):
+                with self.lock:
+                    if self.snapshots.get(key) is snapshot:
+                        self._start(key)
+            return snapshot.value
+
+        # Nothing to serve yet: wait on the single load every caller shares
+        if self.spinner and get_script_run_ctx() is not None:
+            with st.spinner(self.spinner):
+                return future.result()
+        return future.result()
+
+    def _refresh_due(self, key, snapshot):
+        if key in self.in_flight:
+            return False
+        failed_at = self.failed_at.get(key)
+        if failed_at is not None and time.monotonic() - failed_at < REFRESH_RETRY_SECONDS:
+            return False
+        return self.is_stale(snapshot)
+
+    def _start(self, key):
+        # Called with self.lock held
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.pool.submit(self._load, key)
+            self.in_flight[key] = future
+        return future
+
+    def _load(self, key):
+        # Imported here: settings and users build their caches from this module
+        import settings
+        logger = settings.get_logger()
+        start = time.perf_counter()
+        try:
+            value = self.load(*key)
+        except Exception:
+            logger.exception(f"Refreshing {self.name}{list(key)} failed")
+            with self.lock:
+                self.in_flight.pop(key, None)
+                self.failed_at[key] = time.monotonic()
+            raise
+
+        # Swapped in whole - readers see either the old snapshot or the new one
+        with self.lock:
+            self.snapshots[key] = Snapshot(value, dt.datetime.now(dt.timezone.utc))
+            self.failed_at.pop(key, None)
+            self.in_flight.pop(key, None)
+        logger.info(f"Refreshed {self.name}{list(key)} in {time.perf_counter() - start:.2f}s")
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.snapshots.clear()
+            self.failed_at.clear()
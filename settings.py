@@ -12,9 +12,27 @@ import asyncio
 from pyinstrument import Profiler
 from pyinstrument.renderers.console import ConsoleRenderer
 import logging
+import os
+import refresh
 
 default_daterange = [dt.datetime(2021, 1, 1).date(), dt.date.today()]
 
+# "memory" loads every user into the session once; "pushdown" scans the parquet
+# exports per cohort with first_open/country/language predicates pushed down
+USER_DATA_MODE = os.environ.get("USER_DATA_MODE", "memory")
+
+# Output of prepare_user_data.py (gs:// url or local directory).  When set, the
+# dashboard loads these pre-cleaned frames instead of cleaning the raw exports.
+PREPARED_USER_DATA_PATH = os.environ.get("PREPARED_USER_DATA_PATH", "")
+
+# Apps evaluated at once in "All apps" mode (metrics.map_apps).  Filtering and
+# summing are NumPy/pandas work that releases the GIL, so this can be the vCPU count.
+MULTI_APP_WORKERS = int(os.environ.get("MULTI_APP_WORKERS", "4"))
+
+# Log a pyinstrument profile of each shared user data build.  Off by default:
+# the per-stage wall times are always logged (users.build_shared_user_data).
+PROFILE_USER_DATA = os.environ.get("PROFILE_USER_DATA", "").lower() in ("1", "true", "yes")
+
 
 @st.cache_resource(ttl="1d")
 def get_logger(name="dashboard_logger"):
@@ -66,21 +84,35 @@ def initialize():
 
 # Get the campaign data from BigQuery, roll it up per campaign
 def init_campaign_data():
-# Call the combined asynchronous campaign data function
-    df_goog_all, df_fb_all = cache_marketing_data()
-
-    #Get all campaign data by segment_date
-    df_campaigns_all = pd.concat([df_goog_all, df_fb_all])
-    df_campaigns_all = campaigns.add_country_and_language(df_campaigns_all)
-    df_campaigns_all = df_campaigns_all.reset_index(drop=True)
-
     if "df_campaigns_all" not in st.session_state:
-        st.session_state["df_campaigns_all"] = df_campaigns_all
+        # All campaign data by segment_date, with country and language
+        st.session_state["df_campaigns_all"] = get_campaign_spend_store().rows
 
-@st.cache_data(ttl="1d", show_spinner="Gathering Marketing Data")
 def cache_marketing_data():
-    # Execute the async function and return its result synchronously
-    return asyncio.run(campaigns.get_campaign_data())
+    # Shallow copies: callers get their own frames, copy-on-write keeps the data shared
+    _, frames, _ = marketing_data.get()
+    return tuple(df.copy(deep=False) for df in frames)
 
+def get_campaign_spend_store():
+    """campaigns.CampaignSpendStore of the current marketing data snapshot."""
+    _, _, store = marketing_data.get()
+    return store
 
+def load_marketing_data():
+    version = campaigns.get_marketing_data_version()
+    # Execute the async function and return its result synchronously
+    df_goog_all, df_fb_all = asyncio.run(campaigns.get_campaign_data())
 
+    df_campaigns_all = pd.concat([df_goog_all, df_fb_all])
+    df_campaigns_all = campaigns.add_country_and_language(df_campaigns_all)
+    df_campaigns_all = df_campaigns_all.reset_index(drop=True)
+    return version, (df_goog_all, df_fb_all), campaigns.CampaignSpendStore(df_campaigns_all)
+
+# (version, frames, spend store) - refreshed in the background once the
+# campaign tables have a new segment date; sessions keep the previous snapshot meanwhile
+marketing_data = refresh.RefreshingCache(
+    "marketing data",
+    load_marketing_data,
+    is_stale=lambda snapshot: snapshot.value[0] != campaigns.get_marketing_data_version(),
+    spinner="Gathering Marketing Data",
+)
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# The dashboard modules live at the repo root
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import bq_query
+import campaigns
+import users
+from test_campaign_data import backend_for, make_campaign_rows
+
+LOOKUPS = {
+    "language_max_level": pd.DataFrame({"display_language": [" english", "hindi ", "english ", "arabic", " english"]}),
+    "active_countries": pd.DataFrame({"country": ["Brazil", "India", "Kenya"]}),
+    "cr_app_versions": pd.DataFrame({"app_version": ["v1.0.24", "v1.0.25", "v1.1.0", "v1.0.3"]}),
+}
+
+
+# The lookups as they were built before bq_query, from BigQuery Row objects
+# (stand-ins here: one dict per row)
+
+def reference_language_list(rows):
+    df = pd.DataFrame(rows)
+    df.drop_duplicates(inplace=True)
+    lang_list = np.array(df.values).flatten().tolist()
+    return [x.strip(" ") for x in lang_list]
+
+
+def reference_country_list(rows):
+    return np.array(pd.DataFrame(rows).values).flatten().tolist()
+
+
+def reference_app_version_list(rows):
+    df = pd.DataFrame(rows).query("app_version >=  'v1.0.25'")
+    app_versions = np.array(df.values).flatten().tolist()
+    app_versions.insert(0, "All")
+    return app_versions
+
+
+@pytest.fixture
+def local_lookups(monkeypatch):
+    monkeypatch.setattr(bq_query, "default_backend", bq_query.LocalBackend(LOOKUPS, batch_size=2))
+    for query in (users.query_language_list, users.query_country_list, users.query_app_version_list):
+        query.clear()
+
+
+def records(name):
+    return LOOKUPS[name].to_dict("records")
+
+
+def test_lookups_match_the_row_by_row_versions(local_lookups):
+    assert users.query_language_list("v") == reference_language_list(records("language_max_level"))
+    assert users.query_country_list("v") == reference_country_list(records("active_countries"))
+    assert users.query_app_version_list("v") == reference_app_version_list(records("cr_app_versions"))
+
+
+def test_query_dataframe_has_typed_columns():
+    frame = pd.DataFrame({"name": ["a", None, "c"], "cost": [1.5, 2.0, np.nan], "n": [1, 2, 3]})
+    df = bq_query.query_dataframe("SELECT * FROM t", bq_query.LocalBackend({"t": frame}, batch_size=2))
+
+    pd.testing.assert_frame_equal(df, frame.astype({"name": pd.StringDtype("pyarrow")}))
+
+
+def test_query_dataframes_streams_one_frame_per_batch():
+    frame = pd.DataFrame({"n": range(10)})
+    frames = list(bq_query.query_dataframes("SELECT * FROM t", bq_query.LocalBackend({"t": frame}, batch_size=4)))
+
+    assert [len(df) for df in frames] == [4, 4, 2]
+    pd.testing.assert_frame_equal(pd.concat(frames, ignore_index=True), frame)
+
+
+def test_empty_result_is_an_empty_frame():
+    empty = pa.table({"n": pa.array([], pa.int64())})
+    assert bq_query.query_dataframe("SELECT * FROM t", bq_query.LocalBackend({"t": empty})).empty
+
+
+def test_campaign_rows_match_a_whole_frame_fetch():
+    google, facebook = make_campaign_rows("2024-05-01", 60, seed=0)
+    got = asyncio.run(campaigns.get_campaign_data(backend_for(google, facebook), incremental=False))
+
+    # Before bq_query each source was one to_dataframe() result, prepared whole
+    expected = (
+        campaigns.prepare_google_ads_data(google.copy()),
+        campaigns.prepare_facebook_ads_data(facebook.copy()),
+    )
+    for got_df, expected_df in zip(got, expected):
+        # Only the dtypes differ: text columns are Arrow-backed now
+        pd.testing.assert_frame_equal(got_df, expected_df, check_dtype=False)
+
+
+# CL_BENCHMARK_ROWS=300000 python -m pytest -s tests/test_bq_query.py
+BENCHMARK_ROWS = [int(n) for n in os.environ.get("CL_BENCHMARK_ROWS", "").split(",") if n]
+
+
+@pytest.mark.skipif(not BENCHMARK_ROWS, reason="set CL_BENCHMARK_ROWS to run")
+@pytest.mark.parametrize("n", BENCHMARK_ROWS)
+def test_benchmark(n):
+    rng = np.random.default_rng(0)
+    table = pa.table({
+        "campaign_name": [f"CR: english - India {i % 500} Campaign" for i in range(n)],
+        "cost": rng.uniform(0, 50, n),
+        "campaign_id": rng.integers(0, 1000, n),
+    })
+
+    start = time.perf_counter()
+    pd.DataFrame(table.to_pylist())
+    rows = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bq_query.to_pandas(table)
+    arrow = time.perf_counter() - start
+    print(f"\n{n:,} rows: row dicts {rows:.3f}s, Arrow {arrow:.3f}s")
@@ -0,0 +1,89 @@
+import asyncio
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bq_query
+import campaigns
+
+ROW_KEY = ["campaign_id", "segment_date"]
+
+
+def make_campaign_rows(first_day, n_days, seed):
+    """Raw (Google, Facebook) campaign rows as BigQuery returns them."""
+    rng = np.random.default_rng(seed)
+    google, facebook = [], []
+    for day in pd.date_range(first_day, periods=n_days):
+        for c in range(20):
+            google.append({
+                "campaign_id": 1000 + c,
+                "segment_date": day.date(),
+                "campaign_name": f"CR: english - India {c} Campaign",
+                "cost": int(rng.integers(0, 5e7)),
+                "campaign_start_date": pd.Timestamp("2024-04-01").date(),
+                "campaign_end_date": None,
+                "source": "Google",
+            })
+            facebook.append({
+                "campaign_id": 900 + c,
+                "segment_date": day.date(),
+                "campaign_name": f"CR: hindi - Kenya {c} Campaign",
+                "cost": float(rng.uniform(0, 50)),
+                "campaign_start_date": pd.Timestamp("2024-04-01").date(),
+                "campaign_end_date": None,
+                "source": "Facebook",
+            })
+    return pd.DataFrame(google), pd.DataFrame(facebook)
+
+
+def backend_for(google, facebook):
+    """Answers the campaign queries from frames, honouring the segment_date watermark."""
+    def results(sql):
+        since = pd.Timestamp(re.search(r">= '([\d-]+)'", sql).group(1))
+        rows = google if "p_ads_CampaignStats" in sql else facebook
+        return rows[pd.to_datetime(rows["segment_date"]) >= since]
+    return bq_query.LocalBackend(results, batch_size=500)
+
+
+def fetch(backend, store_dir=None, incremental=True):
+    return asyncio.run(campaigns.get_campaign_data(backend, store_dir=store_dir, incremental=incremental))
+
+
+def sorted_rows(df):
+    return df.sort_values(ROW_KEY).reset_index(drop=True)
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return tmp_path / "marketing"
+
+
+def test_incremental_refresh_matches_a_full_pull(store_dir):
+    google, facebook = make_campaign_rows("2024-05-01", 120, seed=0)
+    fetch(backend_for(google, facebook), store_dir)
+
+    # The next day brings new rows and restates cost for the last few days
+    new_google, new_facebook = make_campaign_rows("2024-08-25", 5, seed=1)
+    keep = lambda rows: rows[pd.to_datetime(rows["segment_date"]) < "2024-08-25"]
+    google = pd.concat([keep(google), new_google], ignore_index=True)
+    facebook = pd.concat([keep(facebook), new_facebook], ignore_index=True)
+
+    incremental = fetch(backend_for(google, facebook), store_dir)
+    full = fetch(backend_for(google, facebook), incremental=False)
+
+    for got, expected in zip(incremental, full):
+        # Same values and the same dtypes, so downstream .str and merges don't
+        # depend on which path produced the rows
+        pd.testing.assert_frame_equal(sorted_rows(got), sorted_rows(expected))
+
+
+def test_empty_fetch_keeps_the_stored_rows(store_dir):
+    google, facebook = make_campaign_rows("2024-05-01", 30, seed=0)
+    first = fetch(backend_for(google, facebook), store_dir)
+
+    again = fetch(backend_for(google.iloc[:0], facebook.iloc[:0]), store_dir)
+
+    for got, expected in zip(again, first):
+        pd.testing.assert_frame_equal(sorted_rows(got), sorted_rows(expected))
@@ -0,0 +1,117 @@
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import campaigns
+
+# campaigns.add_country_and_language parses each distinct campaign name once
+# with campaigns.CAMPAIGN_NAME_RE.  This is the five-pass regex version it
+# replaced, kept as the reference the rewrite must match.
+
+
+def reference_add_country_and_language(df):
+
+    # Define the regex patterns
+    country_regex_pattern = r"-\s*(.*)"
+    language_regex_pattern = r":\s*([^-]+?)\s*-"
+    campaign_regex_pattern = r"\s*(.*)Campaign"
+
+    # Extract the country
+    df["country"] = (
+        df["campaign_name"].str.extract(country_regex_pattern)[0].str.strip()
+    )
+
+    # Remove the word "Campaign" if it exists in the country field
+    extracted = df["country"].str.extract(campaign_regex_pattern)
+    df["country"] = extracted[0].fillna(df["country"]).str.strip()
+
+    # Extract the language
+    df["app_language"] = (
+        df["campaign_name"].str.extract(language_regex_pattern)[0].str.strip()
+    )
+
+    # Set default values to None where there's no match
+    country_contains_pattern = r"-\s*(?:.*)"
+    language_contains_pattern = r":\s*(?:[^-]+?)\s*-"
+
+    df["country"] = df["country"].where(
+        df["campaign_name"].str.contains(
+            country_contains_pattern, regex=True, na=False
+        ),
+        None,
+    )
+    df["app_language"] = df["app_language"].where(
+        df["campaign_name"].str.contains(
+            language_contains_pattern, regex=True, na=False
+        ),
+        None,
+    ).str.lower()
+
+    return df
+
+
+def fuzzed_campaign_names(n, seed):
+    """Names built from the separators and words the parser keys on, plus non-strings."""
+    rng = random.Random(seed)
+    tokens = [":", "-", " ", "  ", "Campaign", "campaign", "a", "Eng", "India", "\n", "\t", ": ", "- ", "ñ"]
+    names = ["".join(rng.choice(tokens) for _ in range(rng.randint(0, 9))) for _ in range(n)]
+    return names + [None, np.nan, 5]
+
+
+def campaign_table(n, seed):
+    """Daily campaign rows over a few hundred realistic campaign names."""
+    names = [
+        f"CR: {language} - {country} Campaign"
+        for language in ["English", "hindi", "Arabic", "Swahili", "Urdu"]
+        for country in ["India", "Kenya", "Egypt", "Pakistan", "Brazil", "Iran"]
+    ] * 10
+    names = [f"{name} {i}" if i % 4 else name for i, name in enumerate(names)]
+    return pd.DataFrame({"campaign_name": np.random.default_rng(seed).choice(names, n)})
+
+
+def test_matches_reference_on_fuzzed_names():
+    df = pd.DataFrame({"campaign_name": fuzzed_campaign_names(30_000, seed=0)})
+
+    expected = reference_add_country_and_language(df.copy())
+    got = campaigns.add_country_and_language(df.copy())
+
+    for col in ["country", "app_language"]:
+        mismatches = [
+            (name, e, g)
+            for name, e, g in zip(df["campaign_name"], expected[col], got[col])
+            if not (pd.isna(e) and pd.isna(g)) and e != g
+        ]
+        assert not mismatches, (col, mismatches[:5])
+
+
+def test_matches_reference_on_a_campaign_table():
+    df = campaign_table(20_000, seed=0)
+    pd.testing.assert_frame_equal(
+        campaigns.add_country_and_language(df.copy()),
+        reference_add_country_and_language(df.copy()),
+    )
+
+
+# CL_BENCHMARK_ROWS=60000,600000 python -m pytest -s tests/test_campaign_names.py
+BENCHMARK_ROWS = [int(n) for n in os.environ.get("CL_BENCHMARK_ROWS", "").split(",") if n]
+
+
+@pytest.mark.skipif(not BENCHMARK_ROWS, reason="set CL_BENCHMARK_ROWS to run")
+@pytest.mark.parametrize("n", BENCHMARK_ROWS)
+def test_benchmark(n):
+    df = campaign_table(n, seed=0)
+    campaigns.campaign_name_parts.clear()
+    timings = {}
+    for name, parse in [
+        ("reference", reference_add_country_and_language),
+        ("current (cold)", campaigns.add_country_and_language),
+        ("current (warm)", campaigns.add_country_and_language),
+    ]:
+        start = time.perf_counter()
+        parse(df.copy())
+        timings[name] = time.perf_counter() - start
+    print(f"\n{n:,} rows: " + ", ".join(f"{name} {t:.4f}s" for name, t in timings.items()))
@@ -0,0 +1,141 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import users
+from user_data import make_exports
+
+# users.clean_cr_users_to_single_language was rewritten to work on integer
+# user codes.  This is the implementation it replaced, kept as the reference
+# the rewrite must match row for row.
+
+
+def reference_clean_cr_users_to_single_language(df_app_launch, df_cr_users):
+
+    # ✅  Identify and remove all duplicates from df_app_launch, but SAVE them for later
+    duplicate_user_ids = df_app_launch[df_app_launch.duplicated(subset='user_pseudo_id', keep=False)]
+    df_app_launch = df_app_launch[~df_app_launch["cr_user_id"].isin(duplicate_user_ids["cr_user_id"])]
+
+    # ✅  Get list of users that had duplicates
+    unique_duplicate_ids = duplicate_user_ids['cr_user_id'].unique().tolist()
+
+    # ✅  Define event ranking of the funnel
+    event_order = ["download_completed", "tapped_start", "selected_level", "puzzle_completed", "level_completed"]
+    event_rank = {event: rank for rank, event in enumerate(event_order)}
+
+    # ✅  Ensure "furthest_event" has no missing values
+    df_cr_users["furthest_event"] = df_cr_users["furthest_event"].fillna("unknown")
+
+    # ✅ Map event to numeric rank
+    df_cr_users["event_rank"] = df_cr_users["furthest_event"].map(event_rank)
+
+    # ✅ Flag whether event is "level_completed" - this means we switch to level number to determine furthest progress
+    df_cr_users["is_level_completed"] = df_cr_users["furthest_event"] == "level_completed"
+
+    # ✅ Ensure a single row per user across country & language
+    df_cr_users = df_cr_users.sort_values(["cr_user_id", "is_level_completed", "max_user_level", "event_rank"],
+                                          ascending=[True, False, False, False])
+
+    df_cr_users = df_cr_users.drop_duplicates(subset=["cr_user_id"], keep="first")  # ✅ Keep only best progress row
+
+    # ✅ Ensure every user in df_cr_users has a matching row in df_app_launch
+    users_to_update = df_cr_users[["cr_user_id", "app_language", "country"]].merge(
+        df_app_launch[["cr_user_id", "app_language", "country"]],
+        on="cr_user_id",
+        how="left",
+        suffixes=("_cr", "_app")
+    )
+
+    # ✅ Find users where the `app_language` in df_app_launch does not match the selected best `app_language` from df_cr_users
+    language_mismatch = users_to_update[users_to_update["app_language_cr"] != users_to_update["app_language_app"]]
+
+    if not language_mismatch.empty:
+
+        # ✅ Update df_app_launch to reflect the correct `app_language` from df_cr_users
+        df_app_launch.loc[df_app_launch["cr_user_id"].isin(language_mismatch["cr_user_id"]), "app_language"] = \
+            df_app_launch["cr_user_id"].map(df_cr_users.set_index("cr_user_id")["app_language"])
+
+    # ✅ Ensure all users with duplicates exist in df_cr_users
+    missing_users = set(unique_duplicate_ids) - set(df_cr_users["cr_user_id"])
+
+    # ✅ Add back the correct user rows in df_app_launch, ensuring **matching language & country**
+    users_to_add_back = duplicate_user_ids.merge(
+        df_cr_users[["cr_user_id", "app_language", "country"]],
+        on=["cr_user_id", "app_language", "country"],
+        how="left"
+    )
+
+    # ✅ Drop NaN values to ensure only valid rows are added back
+    users_to_add_back = users_to_add_back.dropna(subset=["app_language"])
+
+    # ✅ If any users are still missing, add a fallback row for them
+    fallback_users = duplicate_user_ids[duplicate_user_ids["cr_user_id"].isin(missing_users)]
+    fallback_users = fallback_users.drop_duplicates(subset="cr_user_id", keep="first")
+
+    # Append the fallback users
+    users_to_add_back = pd.concat([users_to_add_back, fallback_users])
+
+    # ✅ Deduplicate to ensure only one row per cr_user_id is added back
+    users_to_add_back = users_to_add_back.drop_duplicates(subset="cr_user_id", keep="first")
+
+    # ✅ Restore users into df_app_launch
+    df_app_launch = pd.concat([df_app_launch, users_to_add_back])
+
+    # ✅ Ensure df_app_launch has only unique cr_user_id
+
+    df_app_launch = df_app_launch.drop_duplicates(subset="cr_user_id", keep="first")
+
+    # This is a fix for a nasty bug where a user can have a different first_open in one dataframe vs the other.
+    # Its because cr_app_launch is Curious Reader first open but cr_user_progress is FTM first_open
+    mask_cr = df_cr_users["app"] == "CR"
+    df_cr_users.loc[mask_cr, "first_open"] = df_cr_users.loc[mask_cr, "cr_user_id"].map(
+        df_app_launch.set_index("cr_user_id")["first_open"]
+    )
+
+
+    return df_app_launch, df_cr_users
+
+
+
+def make_inputs(n, seed):
+    cr_users, _, app_launch = make_exports(n, seed)
+    for df in (cr_users, app_launch):
+        df["first_open"] = pd.to_datetime(df["first_open"])
+    rng = np.random.default_rng(seed)
+    app_launch.loc[rng.choice(app_launch.index, len(app_launch) // 30), "app_language"] = None
+    cr_users.loc[rng.choice(cr_users.index, len(cr_users) // 50), "max_user_level"] = np.nan
+    return app_launch, cr_users
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_reference(seed):
+    n = [20, 200, 1000, 5000][seed % 4]
+    app_launch, cr_users = make_inputs(n, seed)
+
+    expected = reference_clean_cr_users_to_single_language(app_launch.copy(), cr_users.copy())
+    got = users.clean_cr_users_to_single_language(app_launch.copy(), cr_users.copy())
+
+    for got_df, expected_df in zip(got, expected):
+        pd.testing.assert_frame_equal(got_df, expected_df)
+
+
+# CL_BENCHMARK_ROWS=1000000,5000000,20000000 python -m pytest -s tests/test_clean_cr_users.py
+BENCHMARK_ROWS = [int(n) for n in os.environ.get("CL_BENCHMARK_ROWS", "").split(",") if n]
+
+
+@pytest.mark.skipif(not BENCHMARK_ROWS, reason="set CL_BENCHMARK_ROWS to run")
+@pytest.mark.parametrize("n", BENCHMARK_ROWS)
+def test_benchmark(n):
+    app_launch, cr_users = make_inputs(n, seed=7)
+    timings = {}
+    for name, clean in [
+        ("reference", reference_clean_cr_users_to_single_language),
+        ("current", users.clean_cr_users_to_single_language),
+    ]:
+        start = time.perf_counter()
+        clean(app_launch.copy(), cr_users.copy())
+        timings[name] = time.perf_counter() - start
+    print(f"\n{n:,} rows: reference {timings['reference']:.2f}s, current {timings['current']:.2f}s")
@@ -0,0 +1,108 @@
+import os
+from pathlib import Path
+
+import fsspec
+import pandas as pd
+import pytest
+
+import parquet_cache
+
+
+@pytest.fixture
+def fs(monkeypatch):
+    """A local filesystem standing in for the bucket, counting shard downloads."""
+    fs = fsspec.filesystem("file")
+    fetched = []
+    get_file = fs.get_file
+
+    def counting_get_file(path, *args, **kwargs):
+        fetched.append(path)
+        return get_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(fs, "get_file", counting_get_file)
+    fs.fetched = fetched
+    return fs
+
+
+def write_run(root, dataset, run_date, shards=2, rows=100):
+    run_dir = Path(root) / dataset / f"run_date={run_date}"
+    run_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(shards):
+        path = run_dir / f"{dataset}_{i:03d}.parquet"
+        pd.DataFrame({"n": range(i * rows, (i + 1) * rows)}).to_parquet(path)
+        paths.append(str(path))
+    return paths
+
+
+def test_unchanged_shards_are_reused(fs, tmp_path):
+    shards = write_run(tmp_path / "bucket", "cr_user_progress", "2026-10-17")
+    cache_dir = tmp_path / "mirror"
+
+    first = parquet_cache.mirror_files(fs, shards, cache_dir=cache_dir)
+    second = parquet_cache.mirror_files(fs, shards, cache_dir=cache_dir)
+
+    assert first == second
+    assert len(fs.fetched) == len(shards)
+    assert all(Path(p).exists() for p in first)
+
+
+def test_shard_is_fetched_again_when_its_mtime_changes(fs, tmp_path):
+    shards = write_run(tmp_path / "bucket", "cr_user_progress", "2026-10-17")
+    cache_dir = tmp_path / "mirror"
+    first = parquet_cache.mirror_files(fs, shards, cache_dir=cache_dir)
+
+    stat = os.stat(shards[0])
+    os.utime(shards[0], (stat.st_atime, stat.st_mtime + 60))
+    second = parquet_cache.mirror_files(fs, shards, cache_dir=cache_dir)
+
+    assert second[0] != first[0] and second[1] == first[1]
+    assert fs.fetched == shards + [shards[0]]
+
+
+def test_shard_is_fetched_again_when_its_generation_changes(fs, tmp_path):
+    shards = write_run(tmp_path / "bucket", "cr_user_progress", "2026-10-17")
+    cache_dir = tmp_path / "mirror"
+    size = os.path.getsize(shards[0])
+
+    infos = {path: {"generation": "1", "size": os.path.getsize(path)} for path in shards}
+    first = parquet_cache.mirror_files(fs, shards, infos=infos, cache_dir=cache_dir)
+    infos[shards[0]] = {"generation": "2", "size": size}
+    second = parquet_cache.mirror_files(fs, shards, infos=infos, cache_dir=cache_dir)
+
+    assert second[0] != first[0] and second[1] == first[1]
+    assert len(fs.fetched) == len(shards) + 1
+
+
+def mirrored_run_dirs(cache_dir):
+    return sorted(
+        f"{d.parent.name}/{d.name}" for d in Path(cache_dir).rglob("run_date=*") if d.is_dir()
+    )
+
+
+def test_eviction_drops_old_runs_and_keeps_every_datasets_live_run(fs, tmp_path):
+    bucket, cache_dir = tmp_path / "bucket", tmp_path / "mirror"
+    for dataset in ["cr_user_progress", "cr_app_launch"]:
+        for run_date in ["2026-10-15", "2026-10-16", "2026-10-17"]:
+            parquet_cache.mirror_files(fs, write_run(bucket, dataset, run_date), cache_dir=cache_dir, max_bytes=10**9)
+
+    # Mirroring one dataset over budget must not evict the other's live run
+    shards = write_run(bucket, "cr_user_progress", "2026-10-17")
+    parquet_cache.mirror_files(fs, shards, cache_dir=cache_dir, max_bytes=0)
+
+    assert mirrored_run_dirs(cache_dir) == [
+        "cr_app_launch/run_date=2026-10-17",
+        "cr_user_progress/run_date=2026-10-17",
+    ]
+
+
+def test_eviction_stops_once_the_mirror_fits(fs, tmp_path):
+    bucket, cache_dir = tmp_path / "bucket", tmp_path / "mirror"
+    for run_date in ["2026-10-15", "2026-10-16", "2026-10-17"]:
+        parquet_cache.mirror_files(fs, write_run(bucket, "cr_app_launch", run_date), cache_dir=cache_dir, max_bytes=10**9)
+    run_size = parquet_cache._dir_size(next(Path(cache_dir).rglob("run_date=2026-10-17")))
+
+    evicted = parquet_cache.evict_old_run_dates(cache_dir, max_bytes=2 * run_size)
+
+    assert [Path(d).name for d in evicted] == ["run_date=2026-10-15"]
+    assert mirrored_run_dirs(cache_dir) == ["cr_app_launch/run_date=2026-10-16", "cr_app_launch/run_date=2026-10-17"]
@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+
+import pandas as pd
+
+from conftest import REPO_ROOT
+from user_data import write_exports
+
+RUN_DATE = "2026-10-17"
+
+
+def run_cli(*args):
+    return subprocess.run(
+        [sys.executable, "prepare_user_data.py", *args],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_help():
+    result = run_cli("--help")
+    assert result.returncode == 0, result.stderr
+    assert "--output" in result.stdout
+
+
+def test_prepares_a_local_export(tmp_path):
+    source, output = tmp_path / "bucket", tmp_path / "dashboard_ready"
+    write_exports(source, run_date=RUN_DATE)
+
+    result = run_cli("--source", str(source), "--output", str(output))
+    assert result.returncode == 0, result.stderr
+    # The CLI runs without copy-on-write, so chained writes would warn here
+    assert "SettingWithCopyWarning" not in result.stderr
+
+    run_dir = output / f"run_date={RUN_DATE}"
+    manifest = json.loads((run_dir / "manifest.json").read_text())
+    assert manifest["run_date"] == RUN_DATE
+    assert set(manifest["datasets"]) == {"cr_user_progress", "unity_user_progress", "cr_app_launch"}
+    for entry in manifest["datasets"].values():
+        df = pd.read_parquet(run_dir / entry["file"])
+        assert len(df) == entry["rows"] > 0
+        assert df["first_open"].is_monotonic_increasing
@@ -0,0 +1,67 @@
+import fsspec
+import pandas as pd
+import pytest
+
+import metrics
+import parquet_cache
+import settings
+import users
+from user_data import write_exports
+
+# (app, daterange, language, countries_list) as the sidebar passes them
+CASES = [
+    (["CR"], None, ["All"], ["All"]),
+    (["CR"], [pd.Timestamp("2022-03-01"), pd.Timestamp("2023-06-30")], ["All"], ["All"]),
+    (["CR"], [pd.Timestamp("2021-06-01"), pd.Timestamp("2024-01-31")], ["hindi", "arabic"], ["India", "Egypt"]),
+    (["CR"], None, ["english", "malagasy"], ["All"]),
+    (["CR"], None, ["All"], ["Iran"]),
+    (["WBS-standalone"], [pd.Timestamp("2022-01-01"), pd.Timestamp("2025-01-01")], ["All"], ["Kenya"]),
+    (["Unity"], [pd.Timestamp("2022-01-01"), pd.Timestamp("2024-12-31")], ["All"], ["All"]),
+    (["Unity"], None, ["ukranian", "farsi"], ["Ukraine", "Brazil"]),
+]
+
+
+@pytest.fixture(scope="module")
+def bucket(tmp_path_factory):
+    """Exports, mirror and working directory shared by every case."""
+    root = tmp_path_factory.mktemp("bucket")
+    write_exports(root, n=6000, seed=5)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(root)
+        mp.setattr(settings, "PREPARED_USER_DATA_PATH", None)
+        mp.setattr(parquet_cache, "PARQUET_CACHE_DIR", str(root / "mirror"))
+        mp.setattr(users, "get_gcs_filesystem", lambda: fsspec.filesystem("file"))
+        users.get_user_data_version.clear()
+        users.load_user_frames_pushdown.clear()
+        yield users.get_user_data_version()
+
+
+@pytest.fixture(scope="module")
+def memory_frames(bucket):
+    # build_shared_user_data turns copy-on-write on for the process
+    with pd.option_context("mode.copy_on_write", pd.options.mode.copy_on_write):
+        return users.build_shared_user_data(bucket)
+
+
+def cohort(source, key, app, daterange, language, countries_list):
+    df = metrics.get_user_cohort_df(
+        source[key], daterange, language, countries_list, app,
+        first_open_index=source.get("first_open_index", {}).get(key),
+        dimension_index=source.get("dimension_index", {}).get(key),
+    )
+    id_col = "user_pseudo_id" if key == "df_unity_users" else "cr_user_id"
+    return df.sort_values(id_col).reset_index(drop=True)
+
+
+@pytest.mark.parametrize("app,daterange,language,countries_list", CASES)
+def test_pushdown_cohort_matches_memory_mode(bucket, memory_frames, app, daterange, language, countries_list):
+    pushdown_frames = users.load_user_frames_pushdown(daterange, language, countries_list, bucket)
+
+    keys = [metrics.select_user_dataset_key(app)]
+    if app == ["CR"]:
+        keys.append(metrics.select_user_dataset_key(app, stat="LR"))
+    for key in keys:
+        expected = cohort(memory_frames, key, app, daterange, language, countries_list)
+        result = cohort(pushdown_frames, key, app, daterange, language, countries_list)
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(result[expected.columns], expected)
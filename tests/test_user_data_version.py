@@ -0,0 +1,49 @@
+import fsspec
+import pandas as pd
+import pytest
+
+import settings
+import users
+from user_data import write_exports
+
+RUN_DATE = "2026-10-17"
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    """A local directory standing in for the export bucket."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, "PREPARED_USER_DATA_PATH", None)
+    monkeypatch.setattr(users, "get_gcs_filesystem", lambda: fsspec.filesystem("file"))
+    write_exports(tmp_path, run_date=RUN_DATE)
+    return tmp_path / "user_data_parquet_cache"
+
+
+def version():
+    users.get_user_data_version.clear()
+    return users.get_user_data_version()
+
+
+def test_version_is_stable_for_an_unchanged_export(bucket):
+    assert version() == version()
+    assert f"cr_user_progress={RUN_DATE}:3:" in version()
+
+
+def test_version_changes_when_a_shard_lands_mid_export(bucket):
+    before = version()
+    run_dir = bucket / "cr_user_progress" / f"run_date={RUN_DATE}"
+    pd.read_parquet(run_dir / "cr_user_progress_000.parquet").to_parquet(run_dir / "cr_user_progress_003.parquet")
+    assert f"cr_user_progress={RUN_DATE}:4:" in version()
+    assert version() != before
+
+
+def test_version_changes_when_a_shard_is_rewritten(bucket):
+    before = version()
+    shard = bucket / "cr_app_launch" / f"run_date={RUN_DATE}" / "cr_app_launch_001.parquet"
+    pd.read_parquet(shard).head(10).to_parquet(shard)
+    assert version() != before
+
+
+def test_version_follows_the_latest_run_date(bucket):
+    write_exports(bucket.parent, run_date="2026-10-18")
+    assert "unity_user_progress=2026-10-18:3:" in version()
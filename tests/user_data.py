@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Small synthetic nightly exports, laid out like the bucket:
+#   <root>/user_data_parquet_cache/<dataset>/run_date=<run_date>/<dataset>_NNN.parquet
+
+COUNTRIES = ["Kenya", "India", "Brazil", "Egypt", "Iran", "Ukraine", None]
+LANGUAGES = ["english", "hindi", "ukranian", "arabic", "arabictest", "farsi", "malgache", "swahili"]
+EVENTS = ["download_completed", "tapped_start", "selected_level", "puzzle_completed", "level_completed", None]
+APPS = ["CR", "CR", "CR", "WBS-standalone", "x-standalone"]
+
+
+def make_exports(n=4000, seed=0):
+    """(cr_user_progress, unity_user_progress, cr_app_launch) raw export frames."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2021-01-01")
+
+    def dates(k):
+        return start + pd.to_timedelta(rng.integers(0, 1700, k), unit="D")
+
+    n_users = n // 2
+    cr_user_id = np.array([f"u{i}" for i in rng.integers(0, n_users, n)])
+    first_open = dates(n)
+    cr_users = pd.DataFrame({
+        "cr_user_id": cr_user_id,
+        "user_pseudo_id": [f"p{i}" for i in rng.integers(0, n_users, n)],
+        "first_open": first_open.date,
+        "last_event_date": (first_open + pd.to_timedelta(rng.integers(-3, 100, n), unit="D")).date,
+        "country": rng.choice(np.array(COUNTRIES, dtype=object), n),
+        "app_language": rng.choice(LANGUAGES, n),
+        "app": rng.choice(APPS, n),
+        "furthest_event": rng.choice(np.array(EVENTS, dtype=object), n),
+        "max_user_level": rng.integers(0, 40, n),
+        "gpc": rng.uniform(0, 100, n),
+        "active_span": rng.integers(-5, 100, n),
+        "session_count": rng.integers(0, 9, n),
+    })
+
+    # Mostly one launch per CR user, plus some repeat launches and shared pseudo ids
+    ids = np.unique(cr_user_id)
+    launch_ids = np.concatenate([ids, rng.choice(ids, n // 20)])
+    m = len(launch_ids)
+    app_launch = pd.DataFrame({
+        "cr_user_id": launch_ids,
+        "user_pseudo_id": [f"p{i}" for i in rng.integers(0, n_users, m)],
+        "country": rng.choice(np.array(COUNTRIES, dtype=object), m),
+        "app_language": rng.choice(LANGUAGES, m),
+        "first_open": dates(m).date,
+        "cohort_name": "x",
+    })
+    app_launch.loc[app_launch.index[-50:], "user_pseudo_id"] = app_launch["user_pseudo_id"].iloc[:50].to_numpy()
+
+    k = n // 2
+    unity_users = pd.DataFrame({
+        "user_pseudo_id": [f"q{i}" for i in rng.integers(0, k // 2, k)],
+        "first_open": dates(k).date,
+        "country": rng.choice(np.array(COUNTRIES, dtype=object), k),
+        "app_language": rng.choice(LANGUAGES, k),
+        "app": "Unity",
+        "furthest_event": rng.choice(np.array(["level_completed", "puzzle_completed", "session_start", None], dtype=object), k),
+        "max_user_level": rng.integers(0, 40, k),
+        "gpc": rng.uniform(0, 100, k),
+        "la_date": pd.NaT,
+        "last_event_date": pd.NaT,
+        "active_span": 1,
+    })
+    return cr_users, unity_users, app_launch
+
+
+def write_exports(root, n=4000, seed=0, shards=3, run_date="2026-10-17"):
+    """Write make_exports() under `root` as sharded parquet; returns the frames."""
+    frames = make_exports(n, seed)
+    names = ["cr_user_progress", "unity_user_progress", "cr_app_launch"]
+    for name, df in zip(names, frames):
+        run_dir = os.path.join(root, "user_data_parquet_cache", name, f"run_date={run_date}")
+        os.makedirs(run_dir, exist_ok=True)
+        bounds = np.linspace(0, len(df), shards + 1).astype(int)
+        for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:])):
+            df.iloc[lo:hi].to_parquet(os.path.join(run_dir, f"{name}_{i:03d}.parquet"), index=False)
+    return frames
@@ -9,7 +9,6 @@ from millify import prettify
 
 default_daterange = [dt.datetime(2021, 1, 1).date(), dt.date.today()]
 
-@st.cache_data(ttl="1d", show_spinner=False)
 def stats_by_country_map(
     user_cohort_df,
     user_cohort_df_LR=None,
@@ -17,6 +16,7 @@ def stats_by_country_map(
     option="LR",
     min_funnel=True,
     sort_by="Total",
+    funnel_by_group=None,
 ):
     """
     Draws a choropleth world map showing funnel metrics (LR, LA, RA, etc.)
@@ -36,6 +36,9 @@ def stats_by_country_map(
         If True, use minimal funnel version (CR only)
     sort_by : str, default "Total"
         Sorting behavior ("Total" or "Percent")
+    funnel_by_group : callable, optional
+        groupby_col -> (funnel_df, funnel_steps), used instead of the cohort
+        frames (e.g. metrics.multi_app_funnel_by_group for All apps)
 
     Returns
     -------
@@ -54,6 +57,7 @@ def stats_by_country_map(
         sort_by=sort_by,
         ascending=False,
         use_top_ten=False,  # include all countries
+        funnel=funnel_by_group("country") if funnel_by_group else None,
     )
 
     # Ensure all expected funnel columns exist
@@ -119,12 +123,14 @@ def top_stats_bar_chart(
     app=None,
     option="LA",
     display_category="Country",
-    min_funnel=True
+    min_funnel=True,
+    funnel_by_group=None,
 ):
     """
     Draws a top-10 bar chart by funnel or performance metric.
     Supports dynamic toggle between totals and percentages,
     and auto-formats percentage-based metrics like GPP / GCA.
+    funnel_by_group works as in stats_by_country_map.
     """
     groupby_col = "country" if display_category == "Country" else "app_language"
 
@@ -149,6 +155,7 @@ def top_stats_bar_chart(
         sort_by=sort_mode,
         ascending=False,
         use_top_ten=False,
+        funnel=funnel_by_group(groupby_col) if funnel_by_group else None,
     )
     
     #save the whole dataframe for download purposes
@@ -270,10 +277,13 @@ def create_funnels_by_cohort(
     funnel_size="medium",
     cohort_df_LR=None,
     app=None,
+    funnel=None,
 ):
     """
     Builds a funnel visualization for the selected cohort and app.
-    Uses cached funnel_percent_by_group to compute all step totals at once.
+    Uses cached funnel_percent_by_group to compute all step totals at once,
+    unless `funnel` already holds its (funnel_df, funnel_steps) result, e.g.
+    from metrics.get_cohort_funnel.
     """
 
     funnel_variants = {
@@ -307,13 +317,15 @@ def create_funnels_by_cohort(
     titles = variant["titles"]
 
     # --- Compute all funnel metrics once (cached) ---
-    funnel_df, funnel_steps = funnel_percent_by_group(
-        cohort_df=cohort_df,
-        cohort_df_LR=cohort_df_LR,
-        groupby_col="app_language",  # not used for global totals
-        app=app,
-        min_funnel=(funnel_size == "compact"),
-    )
+    if funnel is None:
+        funnel = funnel_percent_by_group(
+            cohort_df=cohort_df,
+            cohort_df_LR=cohort_df_LR,
+            groupby_col="app_language",  # not used for global totals
+            app=app,
+            min_funnel=(funnel_size == "compact"),
+        )
+    funnel_df, funnel_steps = funnel
 
     # --- Aggregate totals across all groups ---
     totals = {s: funnel_df[s].sum() if s in funnel_df.columns else 0 for s in stats}
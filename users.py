@@ -3,19 +3,42 @@ import pandas as pd
 from rich import print as print
 import numpy as np
 import gcsfs
+import fsspec
+import json
+import posixpath
 import settings
+import parquet_cache
+import datasets
+import indexes
+import bq_query
+import refresh
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from types import MappingProxyType
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 
 
 
 RUN_DATE_RE = re.compile(r"/run_date=\d{4}-\d{2}-\d{2}/")
 
-@st.cache_data(ttl="1d", show_spinner=False)
-def load_parquet_from_gcs(file_pattern: str) -> pd.DataFrame:
+def get_gcs_filesystem():
     credentials, _ = settings.get_gcp_credentials()
-    fs = gcsfs.GCSFileSystem(project="dataexploration-193817", token=credentials)
-
-    files = fs.glob(file_pattern)
+    return gcsfs.GCSFileSystem(project="dataexploration-193817", token=credentials)
+
+def get_filesystem(url):
+    """(filesystem, root path) for a gs:// url or a local directory."""
+    if url.startswith("gs://"):
+        return get_gcs_filesystem(), url[len("gs://"):].strip("/")
+    return fsspec.core.url_to_fs(url)
+
+def list_latest_run(fs, file_pattern: str):
+    """Shards (and their metadata) of the latest run_date matching file_pattern."""
+    infos = fs.glob(file_pattern, detail=True)
+    files = sorted(infos)
     if not files:
         raise FileNotFoundError(f"No files matching pattern: {file_pattern}")
 
@@ -27,23 +50,207 @@ def load_parquet_from_gcs(file_pattern: str) -> pd.DataFrame:
         latest_run_dir = max(set(run_dirs))  # YYYY-MM-DD sorts correctly
         files = [f for f in files if latest_run_dir in f]
 
-    df = pd.read_parquet(files, filesystem=fs).copy()
-    return df
-
-def load_unity_user_progress_from_gcs():
-    return load_parquet_from_gcs(
-        "user_data_parquet_cache/unity_user_progress/run_date=*/unity_user_progress_*.parquet"
+    return files, infos
+
+def mirror_latest_run(file_pattern: str) -> list:
+    """Mirror the shards of the latest run_date matching file_pattern and return the local paths."""
+    fs = get_gcs_filesystem()
+    files, infos = list_latest_run(fs, file_pattern)
+
+    # Read from the local mirror; only new or changed shards are fetched from GCS
+    return parquet_cache.mirror_files(fs, files, infos=infos)
+
+def read_latest_runs(requests, fs=None):
+    """
+    Read several run_date exports at once.  `requests` is a list of
+    (file_pattern, columns) pairs; the shards of all of them share one bounded
+    pool so downloads and decoding overlap across datasets.
+    """
+    fs = fs or get_gcs_filesystem()
+
+    shards = []
+    owners = []
+    for i, (file_pattern, columns) in enumerate(requests):
+        files, infos = list_latest_run(fs, file_pattern)
+        shards += [(f, infos.get(f), columns) for f in files]
+        owners += [i] * len(files)
+
+    tables = parquet_cache.read_shards(fs, shards)
+
+    frames = []
+    for i in range(len(requests)):
+        parts = [t for t, owner in zip(tables, owners) if owner == i]
+        frames.append(pa.concat_tables(parts, promote_options="default").to_pandas())
+    return frames
+
+def load_user_datasets_from_gcs(names=tuple(datasets.USER_DATASETS), fs=None, root=""):
+    """
+    Every user dataset in one concurrent load, projected to its registered columns.
+    Not cached itself - the raw frames only live until build_shared_user_data cleans them.
+    """
+    requests = [
+        (posixpath.join(root, datasets.USER_DATASETS[name]["pattern"]), datasets.get_columns(name))
+        for name in names
+    ]
+    return dict(zip(names, read_latest_runs(requests, fs=fs)))
+
+# ---------------------------------------------------------
+# Dashboard-ready datasets written by prepare_user_data.py
+# ---------------------------------------------------------
+
+PREPARED_MANIFEST = "manifest.json"
+
+def latest_prepared_manifest(fs, root):
+    """Path of the newest complete prepared run - the manifest is written last."""
+    manifests = fs.glob(posixpath.join(root, "run_date=*", PREPARED_MANIFEST))
+    if not manifests:
+        raise FileNotFoundError(f"No prepared user data under: {root}")
+    return max(manifests)  # YYYY-MM-DD sorts correctly
+
+def load_prepared_user_data(url):
+    """Cleaned, typed and first_open-sorted frames from the latest prepared run."""
+    fs, root = get_filesystem(url)
+    manifest_path = latest_prepared_manifest(fs, root)
+    manifest = json.loads(fs.cat_file(manifest_path))
+    run_dir = posixpath.dirname(manifest_path)
+
+    names = list(manifest["datasets"])
+    shards = [(posixpath.join(run_dir, manifest["datasets"][name]["file"]), None, None) for name in names]
+    frames = [table.to_pandas() for table in parquet_cache.read_shards(fs, shards)]
+
+    # Each file carries its own dictionary; bring the categories back in line across frames
+    frames = apply_dimension_dtypes(*frames)
+    # Runs prepared before the funnel codes existed get them here
+    return dict(zip(names, (add_funnel_codes(df) for df in frames)))
+
+def load_dataset_from_gcs(name, all_columns=False):
+    """
+    Load one of datasets.USER_DATASETS, projected to its registered columns.
+    Not cached - the frame is the caller's and is freed once it is dropped.
+    """
+    columns = None if all_columns else datasets.get_columns(name)
+    return read_latest_runs([(datasets.USER_DATASETS[name]["pattern"], columns)])[0]
+
+# ---------------------------------------------------------
+# Pushdown mode: scan only the row groups a cohort can touch
+# ---------------------------------------------------------
+
+@st.cache_resource(max_entries=len(datasets.USER_DATASETS), show_spinner=False)
+def get_user_arrow_dataset(name, version):
+    """
+    pyarrow dataset over the locally mirrored latest run_date of a user
+    export.  `version` (get_user_data_version) only keys the cache.
+    """
+    return ds.dataset(mirror_latest_run(datasets.USER_DATASETS[name]["pattern"]), format="parquet")
+
+def _as_scalar(value, field_type):
+    ts = pd.Timestamp(value)
+    if pa.types.is_date(field_type):
+        return pa.scalar(ts.date(), type=field_type)
+    return pa.scalar(ts.to_pydatetime(), type=field_type)
+
+def cohort_filter_expression(schema, daterange=None, languages=None, countries_list=None):
+    """
+    Arrow expression for the same first_open/country/app_language filters that
+    metrics.get_user_cohort_df applies, usable against row-group statistics.
+    """
+    expr = ds.scalar(True)
+
+    if daterange is not None and len(daterange) == 2 and "first_open" in schema.names:
+        field_type = schema.field("first_open").type
+        expr &= ds.field("first_open") >= _as_scalar(daterange[0], field_type)
+        expr &= ds.field("first_open") <= _as_scalar(daterange[1], field_type)
+
+    if countries_list and countries_list != ["All"] and "country" in schema.names:
+        expr &= ds.field("country").isin(list(countries_list))
+
+    if languages and languages != ["All"] and "app_language" in schema.names:
+        # Match the raw spellings that clean_language_column fixes up later
+        raw_languages = set(languages) | {k for k, v in LANGUAGE_FIXES.items() if v in languages}
+        expr &= ds.field("app_language").isin(sorted(raw_languages))
+
+    return expr
+
+def _scan_ids(name, key, expr, version):
+    dataset = get_user_arrow_dataset(name, version)
+    return dataset.to_table(columns=[key], filter=expr).column(key).unique()
+
+def _scan_rows(name, expr, version):
+    dataset = get_user_arrow_dataset(name, version)
+    columns = [c for c in datasets.get_columns(name) if c in dataset.schema.names]
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def load_user_frames_pushdown(daterange, languages, countries_list, version):
+    """
+    The frames init_user_data builds, restricted to users a cohort can contain,
+    from the export run `version` (get_user_data_version) names.  Shared, not
+    copied per call like st.cache_data would: like get_shared_user_data's
+    frames they are only ever read.
+
+    Cleaning picks one row per user out of all of that user's rows, so the
+    cohort predicates are only pushed down to find candidate users.  Every row
+    of those users is then read and cleaned, and get_user_cohort_df applies the
+    exact filters afterwards - the result matches the in-memory mode.
+    """
+    def candidates(name, key, daterange=daterange, languages=languages, countries_list=countries_list):
+        schema = get_user_arrow_dataset(name, version).schema
+        return _scan_ids(name, key, cohort_filter_expression(schema, daterange, languages, countries_list), version)
+
+    # CR first_open is replaced by the app_launch first_open during cleaning, so a
+    # user also qualifies through a launch in range plus any progress row that
+    # matches the country/language filters.  The app_launch language is in turn
+    # replaced by the chosen progress row's, so the LR cohort can't filter on it.
+    by_dimension = candidates(datasets.CR_USER_PROGRESS, "cr_user_id", daterange=None)
+    by_launch = candidates(datasets.CR_APP_LAUNCH, "cr_user_id", languages=None, countries_list=None)
+    cr_ids = pc.unique(pa.chunked_array([
+        candidates(datasets.CR_USER_PROGRESS, "cr_user_id"),
+        pc.filter(by_launch, pc.is_in(by_launch, value_set=by_dimension)),
+        candidates(datasets.CR_APP_LAUNCH, "cr_user_id", languages=None),
+    ]))
+    unity_ids = candidates(datasets.UNITY_USER_PROGRESS, "user_pseudo_id")
+
+    # App launch duplicates are detected by user_pseudo_id, so pull in every row sharing one
+    launch_expr = ds.field("cr_user_id").isin(cr_ids)
+    pseudo_ids = _scan_ids(datasets.CR_APP_LAUNCH, "user_pseudo_id", launch_expr, version)
+    launch_expr |= ds.field("user_pseudo_id").isin(pseudo_ids)
+
+    df_cr_users = _scan_rows(datasets.CR_USER_PROGRESS, ds.field("cr_user_id").isin(cr_ids), version)
+    df_unity_users = _scan_rows(datasets.UNITY_USER_PROGRESS, ds.field("user_pseudo_id").isin(unity_ids), version)
+    df_cr_app_launch = _scan_rows(datasets.CR_APP_LAUNCH, launch_expr, version)
+
+    df_cr_users, df_unity_users, df_cr_app_launch = prepare_user_frames(
+        df_cr_users, df_unity_users, df_cr_app_launch
     )
+    return {
+        "df_cr_users": df_cr_users,
+        "df_unity_users": df_unity_users,
+        "df_cr_app_launch": df_cr_app_launch,
+    }
 
-def load_cr_user_progress_from_gcs():
-    return load_parquet_from_gcs(
-        "user_data_parquet_cache/cr_user_progress/run_date=*/cr_user_progress_*.parquet"
-    )
+def add_unloaded_columns(cohort_df, name):
+    """
+    Join the columns that were projected away at load time back onto a cleaned
+    cohort, e.g. for the CSV download.  The full-width export is only read
+    here, and is not cached: it is a one-off per download, and keeping it
+    would undo the memory the column projection saves.
+    """
+    full_df = load_dataset_from_gcs(name, all_columns=True)
+    if "app_language" in full_df.columns:
+        full_df["app_language"] = clean_language_column(full_df)
 
-def load_cr_app_launch_from_gcs():
-    return load_parquet_from_gcs(
-        "user_data_parquet_cache/cr_app_launch/run_date=*/cr_app_launch_*.parquet"
-    )
+    row_key = [c for c in datasets.USER_DATASETS[name]["row_key"] if c in cohort_df.columns]
+    extra_cols = [c for c in full_df.columns if c not in cohort_df.columns]
+    if not row_key or not extra_cols:
+        return cohort_df
+
+    # Where the raw export has several rows per key keep the furthest one,
+    # matching the row the cleaning kept
+    if "max_user_level" in full_df.columns:
+        full_df = full_df.sort_values("max_user_level", ascending=False)
+    full_df = full_df.drop_duplicates(subset=row_key, keep="first")
+
+    return cohort_df.merge(full_df[row_key + extra_cols], on=row_key, how="left")
 
 
 
@@ -63,220 +270,478 @@ def ensure_user_data_initialized():
 def init_user_data():
     if st.session_state.get("user_data_initialized"):
         return  # already initialized this session
-    with st.spinner("Loading User Data", show_time=True):
+    if settings.USER_DATA_MODE == "pushdown":
+        # Cohorts are scanned per request by load_user_frames_pushdown
+        st.session_state["user_data_initialized"] = True
+        return
+
+    # Built once per run_date for the whole process, not per session
+    get_shared_user_data()
+    st.session_state["user_data_initialized"] = True
+
+@st.cache_data(ttl="10m", show_spinner=False)
+def get_user_data_version():
+    """
+    Latest run_date folder of every user export with the shards it holds, e.g.
+    "cr_user_progress=2026-10-17:12:3f9c0a1b2d4e|...".  Only lists objects -
+    nothing is read.
+
+    This is the version token of everything derived from the user exports:
+    caches take it as an argument instead of expiring on a ttl, so entries
+    stay valid until a new run lands.  The short ttl here is only how often
+    the bucket is listed.
+
+    The EXPORT DATA jobs write a run's shards one after another, so the shard
+    count and a fingerprint of their generations are part of the token: a
+    snapshot built while an export was still writing is replaced once the
+    rest of the shards land, rather than on the next day's run.
+    """
+    if settings.PREPARED_USER_DATA_PATH:
+        fs, root = get_filesystem(settings.PREPARED_USER_DATA_PATH)
+        return latest_prepared_manifest(fs, root)
+
+    fs = get_gcs_filesystem()
+    latest = []
+    for name, spec in datasets.USER_DATASETS.items():
+        run_dirs = fs.glob(spec["pattern"].rsplit("/", 1)[0])
+        run_dates = [m.group(0) for d in run_dirs if (m := parquet_cache.RUN_DATE_DIR_RE.search(d))]
+        if not run_dates:
+            latest.append(f"{name}=")
+            continue
+        run_date = max(run_dates)
+        infos = fs.glob(spec["pattern"].replace("run_date=*", run_date), detail=True)
+        latest.append(f"{name}={run_date.split('=')[1]}:{len(infos)}:{parquet_cache.listing_fingerprint(infos)}")
+    return "|".join(latest)
+
+def get_shared_user_data():
+    """
+    The cleaned user frames shared by every session in this process, keyed as
+    "df_cr_users", "df_unity_users" and "df_cr_app_launch", plus their
+    "first_open_index" and "dimension_index" (see indexes.py),
+    "funnel_cube" (see build_funnel_cube) and the "version" they were built from.
+
+    The mapping is read-only and the frames must be treated the same way:
+    callers filter or copy them, never assign into them (copy-on-write is on,
+    see settings.initialize).
+    """
+    return shared_user_data.get()
+
+def build_latest_shared_user_data():
+    return build_shared_user_data(get_user_data_version())
+
+# One snapshot per process.  A new export run is built in the background while
+# sessions keep reading the previous one, then swapped in whole.
+shared_user_data = refresh.RefreshingCache(
+    "shared user data",
+    build_latest_shared_user_data,
+    is_stale=lambda snapshot: snapshot.value["version"] != get_user_data_version(),
+    spinner="Loading User Data",
+)
+
+def build_shared_user_data(version):
+    # Derived frames must never write through to the shared ones
+    pd.options.mode.copy_on_write = True
+
+    # Resolved here - the stage workers have no Streamlit script context
+    logger = settings.get_logger()
+    profiler = None
+    if settings.PROFILE_USER_DATA:
         from pyinstrument import Profiler
-        from pyinstrument.renderers.console import ConsoleRenderer
-        import settings
-
         profiler = Profiler(async_mode="disabled")
-        with profiler:
-            # Cached fast parquet loads
-            df_cr_users = load_cr_user_progress_from_gcs()
-
-            df_unity_users = load_unity_user_progress_from_gcs()
-            df_cr_app_launch = load_cr_app_launch_from_gcs()
-
-            # Validation
-            if df_cr_users.empty or df_unity_users.empty or df_cr_app_launch.empty:
-                raise ValueError("❌ One or more dataframes were empty after loading.")
-            
-
-            # Fix dates and clean
-            df_cr_users = fix_date_columns(df_cr_users, ["first_open", "last_event_date"])
-            df_unity_users = fix_date_columns(df_unity_users, ["first_open", "la_date", "last_event_date"])
-            df_cr_app_launch = fix_date_columns(df_cr_app_launch, ["first_open"])
-
-            max_level_indices = df_unity_users.groupby("user_pseudo_id")["max_user_level"].idxmax()
-            df_unity_users = df_unity_users.loc[max_level_indices].reset_index(drop=True)
-
-            df_cr_app_launch["app_language"] = clean_language_column(df_cr_app_launch)
-            df_cr_users["app_language"] = clean_language_column(df_cr_users)
-
-          #  missing_users = df_cr_users[~df_cr_users["cr_user_id"].isin(df_cr_app_launch["cr_user_id"])]
-          #  df_cr_users = df_cr_users[~df_cr_users["cr_user_id"].isin(missing_users["cr_user_id"])]
-
-            df_cr_app_launch, df_cr_users = clean_cr_users_to_single_language(df_cr_app_launch, df_cr_users)
-            
-            #active_span can be negative when users start the game in offline mode and have a first_open date later 
-            # than last_event_date.  Set those to zero
-            df_cr_users["active_span"] = df_cr_users["active_span"].clip(lower=0)
-            
-            # Assign to session state
-            st.session_state["df_cr_users"] = df_cr_users
-            st.session_state["df_unity_users"] = df_unity_users
-            st.session_state["df_cr_app_launch"] = df_cr_app_launch
-            st.session_state["user_data_initialized"] = True
 
-        # Log the profile only once
-        settings.get_logger().debug(
+    # load (all shards concurrently) -> CR clean || Unity clean -> join -> per-frame indexes
+    with timed_stage("total", logger), profiler or nullcontext():
+        with timed_stage("load", logger):
+            if settings.PREPARED_USER_DATA_PATH:
+                # Already cleaned offline by prepare_user_data.py
+                user_data = load_prepared_user_data(settings.PREPARED_USER_DATA_PATH)
+            else:
+                # Shards of all three datasets are fetched concurrently
+                user_data = load_user_datasets_from_gcs()
+        df_cr_users = user_data.pop(datasets.CR_USER_PROGRESS)
+        df_unity_users = user_data.pop(datasets.UNITY_USER_PROGRESS)
+        df_cr_app_launch = user_data.pop(datasets.CR_APP_LAUNCH)
+
+        # Validation
+        if df_cr_users.empty or df_unity_users.empty or df_cr_app_launch.empty:
+            raise ValueError("❌ One or more dataframes were empty after loading.")
+
+        if not settings.PREPARED_USER_DATA_PATH:
+            df_cr_users, df_unity_users, df_cr_app_launch = prepare_user_frames(
+                df_cr_users, df_unity_users, df_cr_app_launch, logger=logger
+            )
+
+        # The three frames are independent from here on
+        frames = {
+            "df_cr_users": df_cr_users,
+            "df_unity_users": df_unity_users,
+            "df_cr_app_launch": df_cr_app_launch,
+        }
+        with ThreadPoolExecutor(max_workers=len(frames)) as pool:
+            built = dict(zip(frames, pool.map(
+                lambda key: build_frame_indexes(key, frames[key], logger), frames
+            )))
+
+    logger.info(f"Built shared user data for {version}")
+    if profiler is not None:
+        from pyinstrument.renderers.console import ConsoleRenderer
+        logger.debug(
             profiler.output(ConsoleRenderer(show_all=False, timeline=True, color=True, unicode=True, short_mode=False))
         )
 
+    shared = {key: df for key, (df, _, _, _) in built.items()}
+    shared["version"] = version
+    shared["first_open_index"] = MappingProxyType({key: b[1] for key, b in built.items()})
+    shared["funnel_cube"] = MappingProxyType({key: b[2] for key, b in built.items()})
+    shared["dimension_index"] = MappingProxyType({key: b[3] for key, b in built.items()})
+    return MappingProxyType(shared)
+
+@contextmanager
+def timed_stage(stage, logger):
+    """Log the wall time of one stage of the shared user data build."""
+    start = time.perf_counter()
+    yield
+    logger.info(f"User data stage {stage}: {time.perf_counter() - start:.2f}s")
+
+def build_frame_indexes(key, df, logger):
+    """
+    One user frame sorted by first_open (so a daterange is a contiguous
+    slice), with its FirstOpenIndex, funnel cube and DimensionIndex per
+    filter column.
+    """
+    with timed_stage(f"index {key}", logger):
+        df = sort_by_first_open(df)
+        first_open_index = indexes.FirstOpenIndex(df["first_open"])
+        cube = build_funnel_cube(df, CUBE_USER_KEYS[key])
+        dimension_index = MappingProxyType({
+            col: indexes.DimensionIndex(df[col]) for col in FILTER_COLUMNS if col in df.columns
+        })
+    return df, first_open_index, cube, dimension_index
+
+def sort_by_first_open(df):
+    if df["first_open"].is_monotonic_increasing:
+        return df  # prepared datasets are written sorted
+    return df.sort_values("first_open", kind="stable", na_position="last").reset_index(drop=True)
+
+def prepare_user_frames(df_cr_users, df_unity_users, df_cr_app_launch, logger=None):
+    """
+    Cleaning applied to the raw exports before any cohort is built.  The
+    Unity and CR cleaning don't depend on each other and run in parallel;
+    the dimension dtypes are then shared across all three frames.
+    """
+    logger = logger or settings.get_logger()
+
+    def run(stage, func, *args):
+        with timed_stage(stage, logger):
+            return func(*args)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        unity = pool.submit(run, "clean Unity", clean_unity_users, df_unity_users)
+        cr = pool.submit(run, "clean CR", clean_cr_users, df_cr_users, df_cr_app_launch)
+        df_unity_users = unity.result()
+        df_cr_users, df_cr_app_launch = cr.result()
+
+    with timed_stage("join", logger):
+        frames = apply_dimension_dtypes(df_cr_users, df_unity_users, df_cr_app_launch)
+        return tuple(add_funnel_codes(df) for df in frames)
+
+def clean_unity_users(df_unity_users):
+    """One row per Unity user - the one with the furthest level."""
+    df_unity_users = fix_date_columns(df_unity_users, ["first_open", "la_date", "last_event_date"])
+    max_level_indices = df_unity_users.groupby("user_pseudo_id")["max_user_level"].idxmax()
+    return df_unity_users.loc[max_level_indices].reset_index(drop=True)
+
+def clean_cr_users(df_cr_users, df_cr_app_launch):
+    """CR progress and app_launch users, each reduced to a single language."""
+    # Fix dates and clean
+    df_cr_users = fix_date_columns(df_cr_users, ["first_open", "last_event_date"])
+    df_cr_app_launch = fix_date_columns(df_cr_app_launch, ["first_open"])
+
+    df_cr_app_launch["app_language"] = clean_language_column(df_cr_app_launch)
+    df_cr_users["app_language"] = clean_language_column(df_cr_users)
+
+  #  missing_users = df_cr_users[~df_cr_users["cr_user_id"].isin(df_cr_app_launch["cr_user_id"])]
+  #  df_cr_users = df_cr_users[~df_cr_users["cr_user_id"].isin(missing_users["cr_user_id"])]
+
+    df_cr_app_launch, df_cr_users = clean_cr_users_to_single_language(df_cr_app_launch, df_cr_users)
+
+    #active_span can be negative when users start the game in offline mode and have a first_open date later 
+    # than last_event_date.  Set those to zero
+    df_cr_users["active_span"] = df_cr_users["active_span"].clip(lower=0)
+    return df_cr_users, df_cr_app_launch
+
+# Low-cardinality columns stored as categoricals so filters and groupbys run on integer codes
+DIMENSION_COLUMNS = ["country", "app_language", "app", "furthest_event"]
+
+# Dimensions the cohort filters select on - each gets an inverted index in the shared data
+FILTER_COLUMNS = ["country", "app_language", "app"]
+
+def apply_dimension_dtypes(*frames):
+    """
+    Convert DIMENSION_COLUMNS to categoricals that share one category set
+    across all frames, so values compare and concat consistently between
+    the CR, Unity and app_launch datasets.
+    """
+    for col in DIMENSION_COLUMNS:
+        values = [df[col].dropna().unique() for df in frames if col in df.columns]
+        if not values:
+            continue
+        dtype = pd.CategoricalDtype(sorted(set(np.concatenate(values))))
+        for df in frames:
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+    return frames
+
 # Language cleanup
+LANGUAGE_FIXES = {
+    "ukranian": "ukrainian",
+    "malgache": "malagasy",
+    "arabictest": "arabic",
+    "farsitest": "farsi"
+}
+
 def clean_language_column(df):
-    return df["app_language"].replace({
-        "ukranian": "ukrainian",
-        "malgache": "malagasy",
-        "arabictest": "arabic",
-        "farsitest": "farsi"
-    })
-
-@st.cache_data(ttl="1d", show_spinner=False)
-def get_language_list():
+    return df["app_language"].replace(LANGUAGE_FIXES)
+
+def funnel_rank(furthest_event):
+    """int8 position of each furthest_event in datasets.EVENT_ORDER, -1 for anything else."""
+    codes, events = pd.factorize(furthest_event)
+    ranks = {event: rank for rank, event in enumerate(datasets.EVENT_ORDER)}
+    # Code -1 (missing) picks up the trailing -1
+    return np.array([ranks.get(e, -1) for e in events] + [-1], dtype=np.int8)[codes]
+
+def funnel_flags(max_user_level, gpc):
+    """uint8 datasets.FUNNEL_FLAG_* bits per row."""
+    la = (max_user_level >= 1).to_numpy()
+    ra = (max_user_level >= 25).to_numpy()
+    gc = la & (gpc >= 90).to_numpy()
+    return (la * datasets.FUNNEL_FLAG_LA | ra * datasets.FUNNEL_FLAG_RA | gc * datasets.FUNNEL_FLAG_GC).astype(np.uint8)
+
+def add_funnel_codes(df):
+    """
+    Add the integer funnel columns the metrics count with: funnel_rank (see
+    funnel_rank) and funnel_flags (see funnel_flags), where the dataset has
+    the columns they come from.
+    """
+    if "furthest_event" in df.columns:
+        df["funnel_rank"] = funnel_rank(df["furthest_event"])
+    if "max_user_level" in df.columns and "gpc" in df.columns:
+        df["funnel_flags"] = funnel_flags(df["max_user_level"], df["gpc"])
+    return df
+
+# Keys of the funnel cube: every cohort filter is a filter on these columns
+CUBE_DIMENSIONS = ["first_open", "country", "app_language", "app"]
+
+# Counts held per cube cell for each frame of the shared user data, and the user key "users" counts
+CUBE_USER_KEYS = {
+    "df_cr_users": "cr_user_id",
+    "df_unity_users": "user_pseudo_id",
+    "df_cr_app_launch": "cr_user_id",
+}
+
+def build_funnel_cube(df, user_key):
+    """
+    Funnel counts of a cleaned frame summed per (first_open, country,
+    app_language, app) - whichever of those the frame has.  The frames hold
+    one row per user, so every count adds up across cells and any cohort's
+    totals are a sum over the cells its filters select.
+
+    Columns per cell:
+      rows, users (rows with a user_key)       - LR as a row count / distinct users
+      DC, TS, SL, PC                           - furthest_event reached the step or later
+      LA, RA, GC, LA_users, GC_users           - funnel_flags counts, by row and by user
+      gpc_sum, gpc_count                       - gpc of LA rows, for GPP
+    """
+    keys = [c for c in CUBE_DIMENSIONS if c in df.columns]
+    has_user = df[user_key].notna().to_numpy() if user_key in df.columns else np.ones(len(df), dtype=bool)
+    counts = {"rows": np.ones(len(df), dtype=np.int64), "users": has_user.astype(np.int64)}
+
+    if "funnel_rank" in df.columns:
+        ranks = df["funnel_rank"].to_numpy()
+        for rank, step in enumerate(["DC", "TS", "SL", "PC"]):
+            counts[step] = (ranks >= rank).astype(np.int64)
+
+    if "funnel_flags" in df.columns:
+        flags = df["funnel_flags"].to_numpy()
+        la = (flags & datasets.FUNNEL_FLAG_LA) > 0
+        gc = (flags & datasets.FUNNEL_FLAG_GC) > 0
+        gpc = df["gpc"].to_numpy(dtype=float, na_value=np.nan)
+        counts.update({
+            "LA": la.astype(np.int64),
+            "RA": ((flags & datasets.FUNNEL_FLAG_RA) > 0).astype(np.int64),
+            "GC": gc.astype(np.int64),
+            "LA_users": (la & has_user).astype(np.int64),
+            "GC_users": (gc & has_user).astype(np.int64),
+            "gpc_sum": np.where(la & ~np.isnan(gpc), gpc, 0.0),
+            "gpc_count": (la & ~np.isnan(gpc)).astype(np.int64),
+        })
+
+    cells = pd.DataFrame(counts, index=df.index)
+    for col in keys:
+        cells[col] = df[col]
+    return cells.groupby(keys, dropna=False, observed=True, sort=False)[list(counts)].sum().reset_index()
 
-    _, bq_client = settings.get_gcp_credentials()
+def get_language_list():
+    return query_language_list(get_user_data_version())
 
+# The user_data lookup tables are loaded by the same nightly pipeline as the
+# exports, so they are keyed on the exports' version
+@st.cache_data(max_entries=2, show_spinner=False)
+def query_language_list(version):
     sql_query = f"""
                 SELECT display_language
                 FROM `dataexploration-193817.user_data.language_max_level`
                 ;
                 """
-    rows_raw = bq_client.query(sql_query)
-    rows = [dict(row) for row in rows_raw]
-    if len(rows) == 0:
+    df = bq_query.query_dataframe(sql_query)
+    if df.empty:
         return pd.DataFrame()
 
-    df = pd.DataFrame(rows)
-    df.drop_duplicates(inplace=True)
-    lang_list = np.array(df.values).flatten().tolist()
-    lang_list = [x.strip(" ") for x in lang_list]
-    return lang_list
+    return df["display_language"].drop_duplicates().str.strip(" ").tolist()
 
 
-@st.cache_data(ttl="1d", show_spinner=False)
 def get_country_list():
-    countries_list = []
-    _, bq_client = settings.get_gcp_credentials()
+    return query_country_list(get_user_data_version())
 
+@st.cache_data(max_entries=2, show_spinner=False)
+def query_country_list(version):
     sql_query = f"""
                 SELECT country
                 FROM `dataexploration-193817.user_data.active_countries`
                 order by country asc
                 ;
                 """
-    rows_raw = bq_client.query(sql_query)
-    rows = [dict(row) for row in rows_raw]
-    if len(rows) == 0:
+    df = bq_query.query_dataframe(sql_query)
+    if df.empty:
         return pd.DataFrame()
 
-    df = pd.DataFrame(rows)
-    countries_list = np.array(df.values).flatten().tolist()
-    return countries_list
+    return df["country"].tolist()
 
 
 # Users who play multiple languages or have multiple countries are consolidated
 # to a single entry based on which combination took them the furthest in the game.
 # If its a tie, will take the first entry. The reference to duplicates are users
 # with multiple entries because of variations in these combinations
+#
+# Every cr_user_id is integer-coded once for both frames, and the per-user
+# decisions are array lookups on those codes instead of merges and isin/map
+# passes.  Not st.cache_data'd: it runs once per run_date in
+# build_shared_user_data (or offline), so hashing its inputs would only add cost.
 
-@st.cache_data(ttl="1d", show_spinner=False)
-def clean_cr_users_to_single_language(df_app_launch, df_cr_users):
-
-    # ✅  Identify and remove all duplicates from df_app_launch, but SAVE them for later
-    duplicate_user_ids = df_app_launch[df_app_launch.duplicated(subset='user_pseudo_id', keep=False)]
-    df_app_launch = df_app_launch[~df_app_launch["cr_user_id"].isin(duplicate_user_ids["cr_user_id"])]
-
-    # ✅  Get list of users that had duplicates
-    unique_duplicate_ids = duplicate_user_ids['cr_user_id'].unique().tolist()
+def _first_positions(codes):
+    """Position of the first occurrence of each distinct code, in row order."""
+    _, first = np.unique(codes, return_index=True)
+    return np.sort(first)
 
-    # ✅  Define event ranking of the funnel
-    event_order = ["download_completed", "tapped_start", "selected_level", "puzzle_completed", "level_completed"]
-    event_rank = {event: rank for rank, event in enumerate(event_order)}
+def clean_cr_users_to_single_language(df_app_launch, df_cr_users):
+    # ✅  Shared integer code per cr_user_id (a missing id is a value of its own),
+    # numbered in sorted id order
+    codes, uniques = pd.factorize(
+        pd.concat([df_app_launch["cr_user_id"], df_cr_users["cr_user_id"]], ignore_index=True),
+        sort=True,
+        use_na_sentinel=False,
+    )
+    launch_codes, user_codes = codes[:len(df_app_launch)], codes[len(df_app_launch):]
+    n_ids = len(uniques)
 
-    # ✅  Ensure "furthest_event" has no missing values
+    # ✅  Ensure "furthest_event" has no missing values, map it to a rank and flag
+    # "level_completed" - this means we switch to level number to determine furthest progress
+    event_rank = {event: rank for rank, event in enumerate(datasets.EVENT_ORDER)}
     df_cr_users["furthest_event"] = df_cr_users["furthest_event"].fillna("unknown")
- 
-    # ✅ Map event to numeric rank
     df_cr_users["event_rank"] = df_cr_users["furthest_event"].map(event_rank)
-
-    # ✅ Flag whether event is "level_completed" - this means we switch to level number to determine furthest progress
     df_cr_users["is_level_completed"] = df_cr_users["furthest_event"] == "level_completed"
 
-    # ✅ Ensure a single row per user across country & language
-    df_cr_users = df_cr_users.sort_values(["cr_user_id", "is_level_completed", "max_user_level", "event_rank"], 
-                                          ascending=[True, False, False, False])
-
-    df_cr_users = df_cr_users.drop_duplicates(subset=["cr_user_id"], keep="first")  # ✅ Keep only best progress row
-
-    # ✅ Ensure every user in df_cr_users has a matching row in df_app_launch
-    users_to_update = df_cr_users[["cr_user_id", "app_language", "country"]].merge(
-        df_app_launch[["cr_user_id", "app_language", "country"]],
-        on="cr_user_id",
-        how="left",
-        suffixes=("_cr", "_app")
-    )
-
-    # ✅ Find users where the `app_language` in df_app_launch does not match the selected best `app_language` from df_cr_users
-    language_mismatch = users_to_update[users_to_update["app_language_cr"] != users_to_update["app_language_app"]]
-    
-    if not language_mismatch.empty:
-
-        # ✅ Update df_app_launch to reflect the correct `app_language` from df_cr_users
-        df_app_launch.loc[df_app_launch["cr_user_id"].isin(language_mismatch["cr_user_id"]), "app_language"] = \
-            df_app_launch["cr_user_id"].map(df_cr_users.set_index("cr_user_id")["app_language"])
-
-    # ✅ Ensure all users with duplicates exist in df_cr_users
-    missing_users = set(unique_duplicate_ids) - set(df_cr_users["cr_user_id"])
-
-    # ✅ Add back the correct user rows in df_app_launch, ensuring **matching language & country**
-    users_to_add_back = duplicate_user_ids.merge(
-        df_cr_users[["cr_user_id", "app_language", "country"]],
-        on=["cr_user_id", "app_language", "country"],
-        how="left"  
-    )
-
-    # ✅ Drop NaN values to ensure only valid rows are added back
-    users_to_add_back = users_to_add_back.dropna(subset=["app_language"])
-
-    # ✅ If any users are still missing, add a fallback row for them
-    fallback_users = duplicate_user_ids[duplicate_user_ids["cr_user_id"].isin(missing_users)]
-    fallback_users = fallback_users.drop_duplicates(subset="cr_user_id", keep="first")
-
-    # Append the fallback users
-    users_to_add_back = pd.concat([users_to_add_back, fallback_users])
-
-    # ✅ Deduplicate to ensure only one row per cr_user_id is added back
-    users_to_add_back = users_to_add_back.drop_duplicates(subset="cr_user_id", keep="first")
-
-    # ✅ Restore users into df_app_launch
-    df_app_launch = pd.concat([df_app_launch, users_to_add_back])
-
-    # ✅ Ensure df_app_launch has only unique cr_user_id
+    # ✅  Composite rank key: user, then level_completed, max_user_level and event rank,
+    # best first with missing values last.  lexsort is stable so ties keep the first entry.
+    order = np.lexsort((
+        -df_cr_users["event_rank"].fillna(-1).to_numpy(dtype=float),
+        -df_cr_users["max_user_level"].to_numpy(dtype=float, na_value=-np.inf),
+        -df_cr_users["is_level_completed"].to_numpy(dtype=np.int8),
+        user_codes,
+    ))
+    sorted_codes = user_codes[order]
+    best_positions = order[np.r_[True, sorted_codes[1:] != sorted_codes[:-1]][:len(order)]]
+
+    # ✅  Keep only the best progress row per user.  A copy, not a view: the
+    # caller writes to it, and prepare_user_data runs without copy-on-write
+    df_cr_users = df_cr_users.iloc[best_positions].copy()
+    best_codes = user_codes[best_positions]
+
+    has_best_row = np.zeros(n_ids, dtype=bool)
+    has_best_row[best_codes] = True
+    best_language = np.empty(n_ids, dtype=object)
+    best_language[best_codes] = df_cr_users["app_language"].to_numpy(dtype=object)
+
+    # ✅  Set aside every user that has app_launch rows sharing a user_pseudo_id
+    is_duplicate = df_app_launch.duplicated(subset="user_pseudo_id", keep=False).to_numpy()
+    has_duplicate = np.zeros(n_ids, dtype=bool)
+    has_duplicate[launch_codes[is_duplicate]] = True
+    keep = ~has_duplicate[launch_codes]
+
+    # ✅  Remaining app_launch rows take the app_language of the user's best progress row
+    kept = df_app_launch[keep]
+    kept_codes = launch_codes[keep]
+    kept = kept.assign(app_language=np.where(
+        has_best_row[kept_codes],
+        best_language[kept_codes],
+        kept["app_language"].to_numpy(dtype=object),
+    ))
+    kept_first = _first_positions(kept_codes)
+
+    # ✅  Add back one row per duplicated user: their first row with a language,
+    # or if they have no progress row at all, their first row
+    duplicates = df_app_launch[is_duplicate]
+    duplicate_codes = launch_codes[is_duplicate]
+    with_language = np.flatnonzero(duplicates["app_language"].notna().to_numpy())
+    add_back = with_language[_first_positions(duplicate_codes[with_language])]
+
+    added = np.zeros(n_ids, dtype=bool)
+    added[duplicate_codes[add_back]] = True
+    first_duplicate = _first_positions(duplicate_codes)
+    fallback_codes = duplicate_codes[first_duplicate]
+    fallback = first_duplicate[~has_best_row[fallback_codes] & ~added[fallback_codes]]
+
+    # ✅  df_app_launch now has a single row per cr_user_id
+    df_app_launch = pd.concat([
+        kept.iloc[kept_first],
+        duplicates.iloc[add_back].set_axis(add_back),
+        duplicates.iloc[fallback],
+    ])
+    launch_row_codes = np.concatenate([
+        kept_codes[kept_first], duplicate_codes[add_back], duplicate_codes[fallback],
+    ])
 
-    df_app_launch = df_app_launch.drop_duplicates(subset="cr_user_id", keep="first")
-    
     # This is a fix for a nasty bug where a user can have a different first_open in one dataframe vs the other.
     # Its because cr_app_launch is Curious Reader first open but cr_user_progress is FTM first_open
-    mask_cr = df_cr_users["app"] == "CR"
-    df_cr_users.loc[mask_cr, "first_open"] = df_cr_users.loc[mask_cr, "cr_user_id"].map(
-        df_app_launch.set_index("cr_user_id")["first_open"]
+    launch_row = np.full(n_ids, -1)
+    launch_row[launch_row_codes] = np.arange(len(df_app_launch))
+    mask_cr = (df_cr_users["app"] == "CR").to_numpy()
+    df_cr_users.loc[mask_cr, "first_open"] = df_app_launch["first_open"].array.take(
+        launch_row[best_codes[mask_cr]], allow_fill=True
     )
-    
 
     return df_app_launch, df_cr_users
 
-@st.cache_data(ttl="1d", show_spinner=False)
 def get_app_version_list():
-    app_versions = []
-    _, bq_client = settings.get_gcp_credentials()
+    return query_app_version_list(get_user_data_version())
 
+@st.cache_data(max_entries=2, show_spinner=False)
+def query_app_version_list(version):
     sql_query = f"""
                 SELECT *
                 FROM `dataexploration-193817.user_data.cr_app_versions`
                 """
-    rows_raw = bq_client.query(sql_query)
-    rows = [dict(row) for row in rows_raw]
-    if len(rows) == 0:
+    df = bq_query.query_dataframe(sql_query)
+    if df.empty:
         return pd.DataFrame()
 
-    df = pd.DataFrame(rows)
     conditions = [
         f"app_version >=  'v1.0.25'",
     ]
     query = " and ".join(conditions)
     df = df.query(query)
 
-    app_versions = np.array(df.values).flatten().tolist()
+    app_versions = df.to_numpy(dtype=object).ravel().tolist()
     app_versions.insert(0, "All")
 
     return app_versions